@@ -0,0 +1,197 @@
+import time
+import json
+import codecs
+import random
+import platform
+import tracemalloc
+from os import makedirs
+from os.path import getsize
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+import numpy
+
+from main import AssetReader, Asset, Pak, Strg, Font, FontTxtr, GlyphAtlas
+
+
+class Benchmark:
+    def __init__(self):
+        self.register_ansi_codec()
+        parser = ArgumentParser(description="Measures codec throughput and peak memory on synthetic game files")
+        parser.add_argument("-o", "--output", default=None, help="Write the JSON results here instead of stdout")
+        parser.add_argument("-s", "--seed", type=int, default=0)
+        parser.add_argument("-r", "--repeat", type=int, default=3)
+        parser.add_argument("-pa", "--pak_assets", type=int, default=500)
+        parser.add_argument("-as", "--asset_size", type=int, default=64 * 1024)
+        parser.add_argument("-sc", "--strg_count", type=int, default=500)
+        parser.add_argument("-ssc", "--strg_string_count", type=int, default=50)
+        parser.add_argument("-l", "--languages", nargs="+", default=["ENGL", "FREN", "GERM", "SPAN"])
+        parser.add_argument("-ts", "--texture_size", type=int, default=512)
+        parser.add_argument("-gc", "--glyph_count", type=int, default=500)
+        arguments = parser.parse_args()
+        self.repeat = arguments.repeat
+        self.results = []
+        with TemporaryDirectory() as folder:
+            data = SyntheticData(folder, arguments.seed)
+            self.benchmark_paks(data, arguments.pak_assets, arguments.asset_size)
+            self.benchmark_strgs(data, arguments.strg_count, arguments.strg_string_count, arguments.languages)
+            self.benchmark_fonts(data, arguments.texture_size, arguments.glyph_count)
+        report = {
+            "Python": platform.python_version(),
+            "Platform": platform.platform(),
+            "Parameters": vars(arguments),
+            "Results": self.results
+        }
+        if arguments.output is None:
+            print(json.dumps(report, indent=2))
+        else:
+            with open(arguments.output, "wt", encoding="UTF-8") as file:
+                json.dump(report, file, indent=2)
+
+    @staticmethod
+    def register_ansi_codec():
+        # "ANSI" exists only on Windows, elsewhere the pak name tables and font names are encoded as cp1252
+        try:
+            codecs.lookup("ANSI")
+        except LookupError:
+            codecs.register(lambda name: codecs.lookup("cp1252") if name == "ansi" else None)
+
+    def measure(self, name, function, bytes_count, items_count):
+        seconds = None
+        for _ in range(self.repeat):
+            start_time = time.perf_counter()
+            function()
+            seconds = min(time.perf_counter() - start_time, seconds or float("inf"))
+        tracemalloc.start()
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.results.append({
+            "Name": name,
+            "Seconds": round(seconds, 6),
+            "Bytes": bytes_count,
+            "Items": items_count,
+            "Bytes per second": round(bytes_count / seconds) if seconds else None,
+            "Items per second": round(items_count / seconds, 3) if seconds else None,
+            "Peak memory": peak_memory
+        })
+
+    def benchmark_paks(self, data, asset_count, asset_size):
+        pak, resource_reader = data.make_pak("Benchmark", asset_count, asset_size)
+        uncompressed_size = sum(len(data_) for data_ in resource_reader.resources.values())
+        self.measure("Pak.save_as_pak", lambda: pak.save_as_pak(data.folder, data.copy_reader(resource_reader)),
+                     uncompressed_size, asset_count)
+        pak_size = getsize(f"{data.folder}/Benchmark.pak")
+        self.measure("Pak.from_pak", lambda: Pak().from_pak(data.folder, "Benchmark", AssetReader()),
+                     pak_size, asset_count)
+        self.measure("Pak.from_pak (memory map)", lambda: data.extract_mapped("Benchmark"), pak_size, asset_count)
+
+    def benchmark_strgs(self, data, strg_count, string_count, languages):
+        strgs = data.make_strgs(strg_count, string_count, languages)
+        paths = [f"{data.folder}/strgs/{strg.id}.STRG" for strg in strgs]
+        strgs_size = sum(len(strg.get_bytes()) for strg in strgs)
+        self.measure("Strg.save_as_strg", lambda: [strg.save_as_strg(path) for strg, path in zip(strgs, paths)],
+                     strgs_size, strg_count)
+        self.measure("Strg.open_strg", lambda: [Strg().open_strg(path) for path in paths], strgs_size, strg_count)
+        opened_strgs = [Strg().open_strg(path) for path in paths]
+        self.measure("Strg.save_as_csv", lambda: Strg.save_as_csv(f"{data.folder}/strgs.csv", opened_strgs),
+                     strgs_size, strg_count)
+        self.measure("Strg.from_csv", lambda: list(Strg.from_csv(f"{data.folder}/strgs.csv", [])),
+                     getsize(f"{data.folder}/strgs.csv"), strg_count)
+
+    def benchmark_fonts(self, data, texture_size, glyph_count):
+        font = data.make_font(texture_size, glyph_count)
+        txtr_path = f"{data.folder}/fonts/{font.texture_id}.TXTR"
+        self.measure("FontTxtr.save_as_txtr", lambda: font.texture.save_as_txtr(txtr_path),
+                     texture_size * texture_size // 2, 1)
+        self.measure("FontTxtr.from_txtr", lambda: FontTxtr().from_txtr(txtr_path), getsize(txtr_path), 1)
+        font.save_as_font_strg(f"{data.folder}/fonts")
+        font_size = getsize(f"{data.folder}/fonts/{font.id}.FONT") + getsize(txtr_path)
+        self.measure("Font.save_as_font_strg", lambda: font.save_as_font_strg(f"{data.folder}/fonts"),
+                     font_size, glyph_count)
+        self.measure("Font.from_font_txtr", lambda: Font().from_font_txtr(f"{data.folder}/fonts/{font.id}.FONT"),
+                     font_size, glyph_count)
+
+
+class SyntheticData:
+    WORDS = ["Samus", "Chozo", "Phazon", "energy", "missile", "the", "of", "a", "scan", "data", "Ёлка", "Größe"]
+
+    def __init__(self, folder, seed):
+        self.folder = folder
+        self.random = random.Random(seed)
+        makedirs(f"{folder}/strgs")
+        makedirs(f"{folder}/fonts")
+
+    def make_asset_data(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk_size = self.random.randint(16, 4096)
+            data += (self.random.randbytes(chunk_size) if self.random.random() < 0.3
+                     else self.random.randbytes(8) * (chunk_size // 8))
+        return bytes(data[:size])
+
+    def make_pak(self, name, asset_count, asset_size):
+        resource_reader = AssetReader()
+        pak = Pak()
+        pak.name = name
+        pak.asset_names = {}
+        pak.assets = []
+        for asset_index in range(asset_count):
+            asset = Asset(self.random.choice(["CMDL", "TXTR", "STRG", "ANIM"]), f"{asset_index + 0x10000000:08X}",
+                          self.random.random() < 0.7, resource_reader)
+            resource_reader.resources[asset.name] = self.make_asset_data(self.random.randint(asset_size // 2,
+                                                                                             asset_size * 3 // 2))
+            pak.assets.append(asset)
+            if asset_index % 10 == 0:
+                pak.asset_names[f"Asset_{asset_index}"] = asset.name
+        return pak, resource_reader
+
+    @staticmethod
+    def copy_reader(resource_reader):
+        copy = AssetReader()
+        copy.resources = dict(resource_reader.resources)
+        return copy
+
+    def extract_mapped(self, pak_name):
+        resource_reader = AssetReader()
+        pak = Pak().from_pak(self.folder, pak_name, resource_reader, True)
+        for asset in pak.assets:
+            resource_reader.get(asset.name, False)
+        pak.close(resource_reader)
+
+    def make_strgs(self, strg_count, string_count, languages):
+        strgs = []
+        for strg_index in range(strg_count):
+            strgs.append(Strg(f"{strg_index + 0x20000000:08X}", 0))
+            strgs[-1].strings = {language: [" ".join(self.random.choices(self.WORDS, k=self.random.randint(0, 30)))
+                                            for _ in range(string_count)] for language in languages}
+        return strgs
+
+    def make_font(self, texture_size, glyph_count):
+        bitmaps = {chr(0x20 + glyph_index): numpy.array([[self.random.random() < 0.5 for _ in range(width)]
+                                                          for _ in range(height)], bool)
+                   for glyph_index, width, height in [(i, self.random.randint(2, 14), self.random.randint(8, 16))
+                                                      for i in range(glyph_count)]}
+        atlas = GlyphAtlas([texture_size, texture_size])
+        placements = atlas.pack(bitmaps)
+        characters = list(bitmaps)
+        font = Font()
+        font.texture = FontTxtr().from_layers([texture_size, texture_size], list(range(16)),
+                                              atlas.render(bitmaps, placements))
+        font.from_dict({
+            "ID": "30000000", "Version": 4, "Width": 16, "Height": 16, "Vertical offset": 12, "Line margin": 2,
+            "?": False, "??": True, "???": 0, "Font size": 16, "Font name": "Benchmark", "Texture id": "30000001",
+            "Texture mode": 0,
+            "Glyphs": {character: {"Left": placements[character][1], "Top": placements[character][2],
+                                   "Right": placements[character][1] + bitmaps[character].shape[1],
+                                   "Bottom": placements[character][2] + bitmaps[character].shape[0],
+                                   "Layer": placements[character][0], "Padding": 1}
+                       for character in characters},
+            "Kerning": {self.random.choice(characters) + self.random.choice(characters): self.random.randint(-2, 2)
+                        for _ in range(glyph_count * 2)}
+        }, font.texture.size)
+        return font
+
+
+if __name__ == "__main__":
+    Benchmark()
@@ -1,14 +1,21 @@
 import time
-from os import listdir, makedirs
-from os.path import exists
+from os import environ, getpid, link, listdir, makedirs, remove, replace, scandir, stat, utime
+from os.path import abspath, exists, isabs
 from argparse import ArgumentParser
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from itertools import accumulate, repeat
 from math import ceil, fabs
 
+import hashlib
+import json
+import mmap
+import re
+import tracemalloc
 import zlib
 import struct
 import csv
-import yaml
-from pygame import Surface, image
 
 
 class Main:
@@ -24,86 +31,525 @@ class Main:
         parser.add_argument("-ff", "--fonts_folder", default="extracted/fonts")
         parser.add_argument("-al", "--additional_languages", nargs="+", default=[])
         parser.add_argument("-ol", "--overwrite_languages", nargs="+", default=[])
+        parser.add_argument("-mm", "--memory_map", action="store_true")
+        parser.add_argument("-j", "--jobs", type=int, default=1)
+        parser.add_argument("-cf", "--cache_folder", default="cache")
+        parser.add_argument("-cs", "--cache_size", type=int, default=1024, help="Cache size limit in MiB")
+        parser.add_argument("-nc", "--no_cache", action="store_true")
+        parser.add_argument("-cl", "--compression_level", choices=list(AssetReader.COMPRESSION_LEVELS),
+                            default="default", help="zlib level of repacked assets: fast for test builds, max for "
+                                                    "release builds")
+        parser.add_argument("-ro", "--reuse_original", action="store_true",
+                            help="Keep the original compressed assets in the cache on extraction and reuse them on "
+                                 "repack for assets that weren't changed")
+        parser.add_argument("-f", "--force", action="store_true", help="Rebuild outputs even if inputs are unchanged")
+        parser.add_argument("-pcf", "--pak_config_formats", choices=["yaml", "json"], nargs="+", default=["yaml"])
+        parser.add_argument("-fp", "--from_paks", action="store_true",
+                            help="Extract strgs and fonts straight from the game paks")
+        parser.add_argument("-p", "--profile", nargs="?", const="profile.json", default=None,
+                            help="Write a Chrome trace of the run and print the slowest stages, paks and assets")
+        parser.add_argument("-pm", "--profile_memory", action="store_true",
+                            help="Also record peak allocations per stage (slows the run down)")
+        parser.add_argument("-cc", "--check_charset", action="store_true",
+                            help="Report characters used in the strgs csv that a repacked font has no glyph for")
+        parser.add_argument("-sf", "--subset_fonts", action="store_true",
+                            help="Drop glyphs and kerning pairs the strgs csv doesn't use and shrink the font textures")
+        parser.add_argument("-tb", "--text_boxes", default=None,
+                            help="YAML file with text box sizes to check every string of the strgs csv against")
+        parser.add_argument("-w", "--watch", action="store_true",
+                            help="Keep running and rebuild what the changed strgs, fonts and pak configs affect")
+        parser.add_argument("-wi", "--watch_interval", type=float, default=0.5, help="Seconds between change checks")
         arguments = parser.parse_args()
-        if arguments.extract == [] and arguments.repack == []:
+        if arguments.profile is not None:
+            Profiler.enable(arguments.profile_memory)
+        compression_cache = None if arguments.no_cache else CompressionCache(f"{arguments.cache_folder}/compression",
+                                                                            arguments.cache_size * 1024 * 1024)
+        if arguments.extract == [] and arguments.repack == [] and arguments.text_boxes is None and not arguments.watch:
             parser.print_help()
+        if arguments.from_paks and ("strgs" in arguments.extract or "fonts" in arguments.extract):
+            with Profiler.stage("Extract from paks", "Main"):
+                self.extract_from_paks(arguments.game_folder, arguments.extract, arguments.strgs_path,
+                                       arguments.fonts_folder, arguments.additional_languages,
+                                       None if arguments.no_cache else f"{arguments.cache_folder}/indexes")
         for format_ in arguments.extract:
-            if format_ == "strgs":
-                self.extract_strgs(arguments.resource_folder, arguments.strgs_path, arguments.additional_languages)
-            elif format_ == "fonts":
-                self.extract_fonts(arguments.resource_folder, arguments.fonts_folder)
-            elif format_ == "paks":
-                self.extract_paks(arguments.game_folder, arguments.resource_folder)
+            if format_ in ["strgs", "fonts"] and arguments.from_paks:
+                continue
+            with Profiler.stage(f"Extract {format_}", "Main"):
+                if format_ == "strgs":
+                    self.extract_strgs(arguments.resource_folder, arguments.strgs_path,
+                                       arguments.additional_languages, arguments.jobs)
+                elif format_ == "fonts":
+                    self.extract_fonts(arguments.resource_folder, arguments.fonts_folder)
+                elif format_ == "paks":
+                    self.extract_paks(arguments.game_folder, arguments.resource_folder, arguments.memory_map,
+                                      arguments.jobs,
+                                      None if arguments.no_cache else f"{arguments.cache_folder}/indexes",
+                                      arguments.pak_config_formats,
+                                      compression_cache if arguments.reuse_original else None)
         for format_ in arguments.repack:
-            if format_ == "strgs":
-                self.repack_strgs(arguments.resource_folder, arguments.strgs_path, arguments.overwrite_languages)
-            elif format_ == "fonts":
-                self.repack_fonts(arguments.resource_folder, arguments.fonts_folder)
-            elif format_ == "paks":
-                self.repack_paks(arguments.resource_folder, arguments.modded_game_folder)
+            with Profiler.stage(f"Repack {format_}", "Main"):
+                if format_ == "strgs":
+                    self.repack_strgs(arguments.resource_folder, arguments.strgs_path, arguments.overwrite_languages,
+                                      arguments.jobs, arguments.force)
+                elif format_ == "fonts":
+                    self.repack_fonts(arguments.resource_folder, arguments.fonts_folder,
+                                      None if arguments.no_cache else f"{arguments.cache_folder}/glyphs",
+                                      arguments.strgs_path if arguments.check_charset or arguments.subset_fonts
+                                      else None, arguments.overwrite_languages, arguments.subset_fonts)
+                elif format_ == "paks":
+                    self.repack_paks(arguments.resource_folder, arguments.modded_game_folder, arguments.jobs,
+                                     compression_cache, arguments.force, arguments.compression_level,
+                                     arguments.reuse_original)
+        if arguments.text_boxes is not None:
+            with Profiler.stage("Check text boxes", "Main"):
+                TextBoxes(arguments.text_boxes, arguments.resource_folder).check(
+                    Strg.from_csv(arguments.strgs_path, arguments.overwrite_languages))
+        if arguments.watch:
+            Watcher(arguments.resource_folder, arguments.modded_game_folder, arguments.strgs_path,
+                    arguments.fonts_folder, arguments.overwrite_languages,
+                    arguments.repack or ["strgs", "fonts", "paks"],
+                    AssetReader(f"{arguments.resource_folder}/files", compression_cache, arguments.compression_level,
+                                arguments.reuse_original), arguments.watch_interval,
+                    None if arguments.no_cache else f"{arguments.cache_folder}/glyphs", arguments.text_boxes).run()
+        if arguments.profile is not None:
+            Profiler.save(arguments.profile)
         print(f"Done in {round(time.time() - start_time, 3)} seconds")
 
     @staticmethod
-    def extract_paks(game_files_folder, resource_folder):
-        resource_reader = AssetReader(resource_folder)
-        for pak in [file[:file.find(".")] for file in listdir(game_files_folder) if file.upper().endswith(".PAK")]:
+    def extract_paks(game_files_folder, resource_folder, memory_map=False, jobs=1, index_folder=None,
+                     config_formats=("yaml",), original_cache=None):
+        if jobs > 1:
+            if memory_map:
+                print("Memory map has no effect with more than 1 job, the workers read the paks themselves")
+            return Main.extract_paks_parallel(game_files_folder, resource_folder, jobs, index_folder, config_formats,
+                                              original_cache)
+        if not exists(f"{resource_folder}/files"):
+            makedirs(f"{resource_folder}/files")
+        asset_store = AssetStore(f"{resource_folder}/files")
+        paks = []
+        for pak_name in [file[:file.find(".")] for file in listdir(game_files_folder)
+                         if file.upper().endswith(".PAK")]:
             start_time = time.time()
-            print(f"Extracting pak {pak}", end="", flush=True)
-            Pak().from_pak(game_files_folder, pak, resource_reader).save_as_files_config(resource_folder)
+            print(f"Extracting pak {pak_name}", end="", flush=True)
+            resource_reader = AssetReader(resource_folder, original_cache, reuse_original=True)
+            paks.append(Pak().from_pak(game_files_folder, pak_name, resource_reader, memory_map, index_folder))
+            paks[-1].save_as_files(asset_store)
+            if memory_map:
+                paks[-1].close(resource_reader)
+            resource_reader.forget([asset.name for asset in paks[-1].assets])
             print(f" (Done in {round(time.time() - start_time, 3)} seconds)")
+        for pak in paks:
+            pak.save_config(resource_folder, asset_store, config_formats)
+        asset_store.report_conflicts()
 
     @staticmethod
-    def repack_paks(resource_folder, modded_game_folder):
-        resource_reader = AssetReader(f"{resource_folder}/files")
-        for pak_config_name in [file for file in listdir(resource_folder) if file.lower().endswith(".yaml")]:
-            start_time = time.time()
-            print(f"Repacking pak {pak_config_name[:pak_config_name.lower().find('.yaml')]}", end="", flush=True)
-            with open(f"{resource_folder}/{pak_config_name}", "rb") as file:
-                pak_config = yaml.safe_load(file)
-            Pak().from_files_config(pak_config_name[:pak_config_name.lower().find(".yaml")],
-                                    resource_reader, pak_config).save_as_pak(modded_game_folder, resource_reader)
-            print(f" (Done in {round(time.time() - start_time, 3)} seconds)")
+    def extract_paks_parallel(game_files_folder, resource_folder, jobs, index_folder=None, config_formats=("yaml",),
+                              original_cache=None):
+        if not exists(f"{resource_folder}/files"):
+            makedirs(f"{resource_folder}/files")
+        resource_reader = AssetReader(resource_folder)
+        asset_store = AssetStore(f"{resource_folder}/files")
+        paks = []
+        pak_tasks = []
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            for pak_name in [file[:file.find(".")] for file in listdir(game_files_folder)
+                             if file.upper().endswith(".PAK")]:
+                paks.append(Pak().from_index(pak_name, PakIndex().from_pak(f"{game_files_folder}/{pak_name}.pak",
+                                                                           index_folder), resource_reader))
+                chunks = [[]]
+                chunk_size = 0
+                for asset, (asset_offset, asset_size) in zip(paks[-1].assets, paks[-1].asset_locations):
+                    if chunk_size >= Pak.EXTRACTION_CHUNK_SIZE:
+                        chunks.append([])
+                        chunk_size = 0
+                    chunks[-1].append((asset.name, asset_offset, asset_size, asset.is_compressed,
+                                       asset_store.register(asset.name, pak_name)))
+                    chunk_size += asset_size
+                pak_tasks.append((pak_name, [pool.submit(Pak.extract_assets, f"{game_files_folder}/{pak_name}.pak",
+                                                         chunk, f"{resource_folder}/files", original_cache)
+                                             for chunk in chunks]))
+            for pak in paks:
+                pak.save_config(resource_folder, asset_store, config_formats)
+            for pak_name, futures in pak_tasks:
+                results = [future.result() for future in futures]
+                for _, _, digests in results:
+                    for asset_name, digest in digests:
+                        asset_store.check(asset_name, pak_name, digest)
+                print(f"Extracting pak {pak_name} (Done in "
+                      f"{round(max(i[1] for i in results) - min(i[0] for i in results), 3)} seconds)")
+        asset_store.report_conflicts()
+
+    @staticmethod
+    def repack_paks(resource_folder, modded_game_folder, jobs=1, compression_cache=None, force=False,
+                    compression_level="default", reuse_original=False):
+        resource_reader = AssetReader(f"{resource_folder}/files", compression_cache, compression_level, reuse_original)
+        manifest = BuildManifest(f"{resource_folder}/paks.manifest")
+        compression_settings = resource_reader.compression_settings + (", reusing originals"
+                                                                       if resource_reader.reuse_original else "")
+        pak_configs = Main.get_outdated_pak_configs(resource_folder, modded_game_folder, manifest, force,
+                                                    compression_settings)
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(jobs) as pool:
+                paks = [(Pak().from_files_config(pak_name, resource_reader, pak_config), inputs)
+                        for pak_name, pak_config, inputs in pak_configs]
+                for pak, _ in paks:
+                    for asset in pak.assets:
+                        if asset.is_compressed:
+                            resource_reader.compress(asset.name, pool)
+                for pak, inputs in paks:
+                    start_time = time.time()
+                    print(f"Repacking pak {pak.name}", end="", flush=True)
+                    pak.save_as_pak(modded_game_folder, resource_reader)
+                    manifest.set(pak.name, inputs, f"{modded_game_folder}/{pak.name}.pak")
+                    print(f" (Done in {round(time.time() - start_time, 3)} seconds)")
+        else:
+            for pak_name, pak_config, inputs in pak_configs:
+                start_time = time.time()
+                print(f"Repacking pak {pak_name}", end="", flush=True)
+                Pak().from_files_config(pak_name, resource_reader,
+                                        pak_config).save_as_pak(modded_game_folder, resource_reader)
+                manifest.set(pak_name, inputs, f"{modded_game_folder}/{pak_name}.pak")
+                print(f" (Done in {round(time.time() - start_time, 3)} seconds)")
+        manifest.save()
+        if compression_cache is not None:
+            compression_cache.trim()
+
+    @staticmethod
+    def get_outdated_pak_configs(resource_folder, modded_game_folder, manifest, force, compression_settings):
+        file_signatures = {}
+        for pak_name, pak_config_name in Main.get_pak_config_names(resource_folder).items():
+            pak_config = Main.load_pak_config(f"{resource_folder}/{pak_config_name}")
+            for asset in pak_config["Assets info"]:
+                file_name = f"{asset['ID']}.{asset['Type']}"
+                if file_name not in file_signatures:
+                    file_signatures[file_name] = BuildManifest.get_signature(f"{resource_folder}/files/{file_name}")
+            inputs = {
+                "Config": BuildManifest.get_signature(f"{resource_folder}/{pak_config_name}"),
+                "Compression": compression_settings,
+                "Files": {f"{asset['ID']}.{asset['Type']}": file_signatures[f"{asset['ID']}.{asset['Type']}"]
+                          for asset in pak_config["Assets info"]}
+            }
+            if not force and manifest.is_up_to_date(pak_name, inputs, f"{modded_game_folder}/{pak_name}.pak"):
+                print(f"Skipping pak {pak_name} (up to date)")
+                continue
+            yield pak_name, pak_config, inputs
 
     @staticmethod
-    def extract_strgs(resource_folder, strgs_path, additional_languages):
-        strgs = [Strg().open_strg(f"{resource_folder}/files/{file_name}")
+    def get_pak_config_names(resource_folder):
+        pak_config_names = {}
+        for file in listdir(resource_folder):
+            if not file.lower().endswith((".yaml", ".json")):
+                continue
+            pak_name = file[:file.rfind(".")]
+            if pak_name not in pak_config_names or (
+                    stat(f"{resource_folder}/{file}").st_mtime_ns >
+                    stat(f"{resource_folder}/{pak_config_names[pak_name]}").st_mtime_ns):
+                pak_config_names[pak_name] = file
+        return pak_config_names
+
+    @staticmethod
+    def load_pak_config(path):
+        import yaml
+        with Profiler.stage("Load pak config", "Main", {"Path": path}):
+            with open(path, "rb") as file:
+                if path.lower().endswith(".json"):
+                    return json.load(file)
+                return yaml.load(file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+    @staticmethod
+    def extract_strgs(resource_folder, strgs_path, additional_languages, jobs=1):
+        paths = [f"{resource_folder}/files/{file_name}"
                  for file_name in listdir(f"{resource_folder}/files") if file_name.endswith(".STRG")]
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(jobs) as pool:
+                strgs = list(pool.map(Main.open_strg, paths, chunksize=max(1, len(paths) // (jobs * 8))))
+        else:
+            strgs = [Main.open_strg(path) for path in paths]
         Strg.save_as_csv(strgs_path, strgs, additional_languages)
 
     @staticmethod
-    def repack_strgs(resources_folder, strgs_path, overwrite_languages):
-        for strg in Strg.from_csv(strgs_path, overwrite_languages):
-            strg.save_as_strg(f"{resources_folder}/files/{strg.id[2:]}.STRG")
+    def repack_strgs(resources_folder, strgs_path, overwrite_languages, jobs=1, force=False):
+        manifest = BuildManifest(f"{resources_folder}/strgs.manifest")
+        strgs = Strg.from_csv(strgs_path, overwrite_languages)
+        if jobs > 1:
+            strgs = list(strgs)
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(jobs) as pool:
+                entries = list(pool.map(Main.save_strg, strgs, repeat(resources_folder),
+                                        [None if force else manifest.entries.get(strg.id) for strg in strgs],
+                                        chunksize=64))
+        else:
+            entries = [Main.save_strg(strg, resources_folder, None if force else manifest.entries.get(strg.id))
+                       for strg in strgs]
+        written_count = 0
+        for strg_id, entry in entries:
+            written_count += entry != manifest.entries.get(strg_id)
+            manifest.entries[strg_id] = entry
+        manifest.save()
+        print(f"Written {written_count} of {len(entries)} STRGs")
+
+    @staticmethod
+    def open_strg(path):
+        return Strg().open_strg(path)
+
+    @staticmethod
+    def save_strg(strg, resources_folder, manifest_entry):
+        path = f"{resources_folder}/files/{strg.id[2:]}.STRG"
+        buffer = strg.get_bytes()
+        inputs = hashlib.sha256(buffer).hexdigest()
+        if not BuildManifest.is_entry_up_to_date(manifest_entry, inputs, path):
+            with Profiler.stage("Write file", "Strg", {"Asset": f"{strg.id[2:]}.STRG", "Bytes": len(buffer)}):
+                with open(path, "wb") as file:
+                    file.write(buffer)
+        return strg.id, BuildManifest.create_entry(inputs, path)
 
     @staticmethod
     def extract_fonts(resource_folder, fonts_folder):
         font_paths = [file for file in listdir(f"{resource_folder}/files") if file.endswith(".FONT")]
-        for path in font_paths:
-            font = Font().from_font_txtr(f"{resource_folder}/files/{path}")
+        Main.save_fonts([Font().from_font_txtr(f"{resource_folder}/files/{path}") for path in font_paths], fonts_folder)
+
+    @staticmethod
+    def extract_from_paks(game_files_folder, formats, strgs_path, fonts_folder, additional_languages,
+                          index_folder=None):
+        types = {"STRG"} if "strgs" in formats else set()
+        types |= {"FONT", "TXTR"} if "fonts" in formats else set()
+        indexes = {}
+        for pak_name in [file for file in listdir(game_files_folder) if file.upper().endswith(".PAK")]:
+            index = PakIndex().from_pak(f"{game_files_folder}/{pak_name}", index_folder)
+            for entry in index.get_entries(types):
+                indexes.setdefault(f"{entry['ID']}.{entry['Type']}", index)
+        strgs = [Strg().from_bytes(name.split(".")[0], indexes[name].read(name))
+                 for name in indexes if name.endswith(".STRG")]
+        if "strgs" in formats:
+            Strg.save_as_csv(strgs_path, strgs, additional_languages)
+
+        def load_texture(texture_id):
+            texture_name = f"{texture_id.upper().rjust(8, '0')}.TXTR"
+            return FontTxtr().from_bytes(indexes[texture_name].read(texture_name), texture_name)
+
+        Main.save_fonts([Font().from_bytes(name.split(".")[0], indexes[name].read(name), load_texture)
+                         for name in indexes if name.endswith(".FONT")], fonts_folder)
+
+    @staticmethod
+    def save_fonts(fonts, fonts_folder):
+        for font in fonts:
             path = f"{fonts_folder}/{font.font_name} {font.font_size} {font.id}"
             if not exists(path):
                 makedirs(path)
             font.save_as_yaml_pngs(path)
 
     @staticmethod
-    def repack_fonts(resource_folder, fonts_folder):
-        fonts = [Font().from_yaml_pngs(f"{fonts_folder}/{path}") for path in listdir(fonts_folder)]
+    def repack_fonts(resource_folder, fonts_folder, glyph_cache_folder=None, strgs_path=None, overwrite_languages=(),
+                     subset=False):
+        charset = None if strgs_path is None else Charset().from_strgs(Strg.from_csv(strgs_path, overwrite_languages))
+        fonts = [Font().from_yaml_pngs(f"{fonts_folder}/{path}", glyph_cache_folder, charset, subset)
+                 for path in listdir(fonts_folder)]
         for font in fonts:
             font.save_as_font_strg(f"{resource_folder}/files")
 
 
+class Watcher:
+    def __init__(self, resource_folder, modded_game_folder, strgs_path, fonts_folder, overwrite_languages, formats,
+                 resource_reader, interval=0.5, glyph_cache_folder=None, text_boxes_path=None):
+        self.resource_folder = resource_folder
+        self.modded_game_folder = modded_game_folder
+        self.strgs_path = strgs_path
+        self.fonts_folder = fonts_folder
+        self.overwrite_languages = overwrite_languages
+        self.formats = formats
+        self.resource_reader = resource_reader
+        self.interval = interval
+        self.glyph_cache_folder = glyph_cache_folder
+        self.text_boxes_path = text_boxes_path
+        self.signatures = self.get_signatures()
+        self.pak_configs = {}
+        self.asset_paks = {}
+        self.is_strgs_outdated = False
+        self.outdated_fonts = set()
+        self.outdated_paks = set()
+        for pak_name in Main.get_pak_config_names(resource_folder):
+            self.load_pak_config(pak_name)
+        self.outdated_paks.clear()
+
+    def run(self):
+        print(f"Watching {', '.join(self.formats)} for changes (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(self.interval)
+                self.update()
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        if self.resource_reader.compression_cache is not None:
+            self.resource_reader.compression_cache.trim()
+
+    def update(self):
+        try:
+            if not self.check_changes():
+                return
+            start_time = time.time()
+            is_text_changed = self.is_strgs_outdated or len(self.outdated_fonts) > 0
+            if self.is_strgs_outdated:
+                Main.repack_strgs(self.resource_folder, self.strgs_path, self.overwrite_languages)
+                self.is_strgs_outdated = False
+            for font_folder in sorted(self.outdated_fonts):
+                self.repack_font(font_folder)
+                self.outdated_fonts.discard(font_folder)
+            if is_text_changed and self.text_boxes_path is not None:
+                TextBoxes(self.text_boxes_path, self.resource_folder).check(
+                    Strg.from_csv(self.strgs_path, self.overwrite_languages))
+            self.check_changes()
+            for pak_name in sorted(self.outdated_paks):
+                self.repack_pak(pak_name)
+                self.outdated_paks.discard(pak_name)
+            print(f"Rebuilt in {round(time.time() - start_time, 3)} seconds")
+        except Exception as exception:
+            print(f"Rebuild failed, waiting for the next change: {exception}")
+
+    def check_changes(self):
+        signatures = self.get_signatures()
+        changed_paths = [path for path in signatures.keys() | self.signatures.keys()
+                         if signatures.get(path) != self.signatures.get(path)]
+        self.signatures = signatures
+        changed_assets = set()
+        changed_pak_names = set()
+        for path in changed_paths:
+            folder, _, name = path.rpartition("/")
+            if path == self.strgs_path:
+                self.is_strgs_outdated = "strgs" in self.formats
+            elif path.startswith(f"{self.fonts_folder}/"):
+                self.outdated_fonts.add(f"{self.fonts_folder}/{path[len(self.fonts_folder) + 1:].split('/')[0]}")
+            elif folder == f"{self.resource_folder}/files":
+                changed_assets.add(name)
+            elif folder == self.resource_folder and name.lower().endswith((".yaml", ".json")):
+                changed_pak_names.add(name[:name.rfind(".")])
+        self.resource_reader.forget(changed_assets)
+        for asset_name in changed_assets:
+            self.outdated_paks |= self.asset_paks.get(asset_name, set())
+        for pak_name in sorted(changed_pak_names):
+            try:
+                self.load_pak_config(pak_name)
+            except Exception as exception:
+                print(f"Couldn't load the config of pak {pak_name}, waiting for it to change: {exception}")
+        return len(changed_paths) > 0
+
+    def get_signatures(self):
+        signatures = {}
+        if "strgs" in self.formats:
+            signatures[self.strgs_path] = BuildManifest.get_signature(self.strgs_path)
+        if "fonts" in self.formats and exists(self.fonts_folder):
+            self.scan_folder(self.fonts_folder, signatures, True)
+        self.scan_folder(self.resource_folder, signatures, False)
+        self.scan_folder(f"{self.resource_folder}/files", signatures, False)
+        return signatures
+
+    @staticmethod
+    def scan_folder(folder, signatures, recursive):
+        for entry in scandir(folder):
+            if entry.is_dir():
+                if recursive:
+                    Watcher.scan_folder(f"{folder}/{entry.name}", signatures, True)
+            elif not entry.name.endswith(".tmp"):
+                entry_stat = entry.stat()
+                signatures[f"{folder}/{entry.name}"] = [entry_stat.st_mtime_ns, entry_stat.st_size]
+
+    def load_pak_config(self, pak_name):
+        for pak_names in self.asset_paks.values():
+            pak_names.discard(pak_name)
+        self.pak_configs.pop(pak_name, None)
+        self.outdated_paks.discard(pak_name)
+        pak_config_name = Main.get_pak_config_names(self.resource_folder).get(pak_name)
+        if pak_config_name is None or "paks" not in self.formats:
+            return
+        self.pak_configs[pak_name] = Main.load_pak_config(f"{self.resource_folder}/{pak_config_name}")
+        for asset in self.pak_configs[pak_name]["Assets info"]:
+            self.asset_paks.setdefault(f"{asset['ID']}.{asset['Type']}", set()).add(pak_name)
+        self.outdated_paks.add(pak_name)
+
+    def repack_font(self, font_folder):
+        if exists(f"{font_folder}/Font.yaml"):
+            print(f"Repacking font {font_folder}")
+            Font().from_yaml_pngs(font_folder, self.glyph_cache_folder).save_as_font_strg(
+                f"{self.resource_folder}/files")
+
+    def repack_pak(self, pak_name):
+        start_time = time.time()
+        print(f"Repacking pak {pak_name}", end="", flush=True)
+        Pak().from_files_config(pak_name, self.resource_reader,
+                                self.pak_configs[pak_name]).save_as_pak(self.modded_game_folder, self.resource_reader)
+        print(f" (Done in {round(time.time() - start_time, 3)} seconds)")
+
+
 class AssetReader:
-    def __init__(self, folder=""):
+    COMPRESSION_LEVELS = {"fast": 1, "default": zlib.Z_DEFAULT_COMPRESSION, "max": 9}
+    ORIGINAL_SETTINGS = "original"
+    MAX_SIZE = 0xFFFFFFFF
+
+    def __init__(self, folder="", compression_cache=None, compression_level="default", reuse_original=False):
         self.folder = folder
+        self.compression_cache = compression_cache
+        self.compression_level = self.COMPRESSION_LEVELS[compression_level]
+        self.compression_settings = f"zlib {zlib.ZLIB_RUNTIME_VERSION} level {self.compression_level}"
+        self.reuse_original = reuse_original and compression_cache is not None
         self.resources = {}
+        self.compressed_resources = {}
+        self.compression_keys = {}
 
     def get(self, resource_name, align, compress=False):
-        data = self.compress_resource(self.resources[resource_name]) if compress else self.resources[resource_name]
+        data = self.get_compressed(resource_name) if compress else self.load(resource_name)
         return self.align(data) if align else data
 
+    def load(self, resource_name):
+        data = self.resources[resource_name]
+        if not isinstance(data, MappedResource):
+            return data
+        with Profiler.stage("Decompress" if data.is_compressed else "Copy", "AssetReader",
+                            {"Asset": resource_name, "Bytes": len(data.view)}):
+            loaded_data = data.load()
+        if data.is_compressed and self.reuse_original:
+            self.compression_cache.set_original(loaded_data, data.view)
+        return loaded_data
+
+    def compress(self, resource_name, pool=None):
+        if resource_name in self.compressed_resources:
+            return
+        data = self.load(resource_name)
+        if self.compression_cache is not None:
+            with Profiler.stage("Cache lookup", "AssetReader", {"Asset": resource_name}):
+                if self.reuse_original:
+                    self.compressed_resources[resource_name] = self.compression_cache.get_original(data)
+                    if self.compressed_resources[resource_name] is not None:
+                        return
+                key = self.compression_cache.get_key(data, self.compression_settings)
+                self.compressed_resources[resource_name] = self.compression_cache.get(key)
+            if self.compressed_resources[resource_name] is not None:
+                return
+            self.compression_keys[resource_name] = key
+        if pool is not None:
+            self.compressed_resources[resource_name] = pool.submit(self.compress_resource, data, self.compression_level)
+            return
+        with Profiler.stage("Compress", "AssetReader", {"Asset": resource_name, "Bytes": len(data)}):
+            self.compressed_resources[resource_name] = self.compress_resource(data, self.compression_level)
+
+    def get_compressed(self, resource_name):
+        from concurrent.futures import Future
+        self.compress(resource_name)
+        if isinstance(self.compressed_resources[resource_name], Future):
+            with Profiler.stage("Wait for compression", "AssetReader", {"Asset": resource_name}):
+                self.compressed_resources[resource_name] = self.compressed_resources[resource_name].result()
+        if resource_name in self.compression_keys:
+            with Profiler.stage("Cache store", "AssetReader", {"Asset": resource_name}):
+                self.compression_cache.set(self.compression_keys.pop(resource_name),
+                                           self.compressed_resources[resource_name])
+        return self.compressed_resources[resource_name]
+
     @staticmethod
-    def compress_resource(data):
-        return struct.pack(">L", len(data)) + zlib.compress(data)
+    def compress_resource(data, level=zlib.Z_DEFAULT_COMPRESSION):
+        if len(data) > AssetReader.MAX_SIZE:
+            raise Exception(f"Can't compress {len(data)} bytes, the decompressed size must fit into 32 bits")
+        return struct.pack(">L", len(data)) + zlib.compress(data, level)
 
     @staticmethod
     def decompress_resource(data):
@@ -115,16 +561,249 @@ class AssetReader:
 
     def read_file(self, resource_name, is_compressed=False):
         if resource_name not in self.resources:
-            with open(f"{self.folder}/{resource_name}", "rb") as file:
-                self.resources[resource_name] = file.read()
+            with Profiler.stage("Read file", "AssetReader", {"Asset": resource_name}) as args:
+                with open(f"{self.folder}/{resource_name}", "rb") as file:
+                    self.resources[resource_name] = file.read()
+                args["Bytes"] = len(self.resources[resource_name])
             if is_compressed:
-                self.resources[resource_name] = self.decompress_resource(self.resources[resource_name])
+                with Profiler.stage("Decompress", "AssetReader", {"Asset": resource_name, "Bytes": args["Bytes"]}):
+                    self.resources[resource_name] = self.decompress_resource(self.resources[resource_name])
 
-    def set_raw_data(self, resource_name, data, is_compressed):
+    def set_raw_data(self, resource_name, data, is_compressed, lazy=False):
         if resource_name not in self.resources:
+            if lazy:
+                self.resources[resource_name] = MappedResource(data, is_compressed)
+                return
             self.resources[resource_name] = data
             if is_compressed:
-                self.resources[resource_name] = self.decompress_resource(self.resources[resource_name])
+                with Profiler.stage("Decompress", "AssetReader", {"Asset": resource_name, "Bytes": len(data)}):
+                    self.resources[resource_name] = self.decompress_resource(self.resources[resource_name])
+                if self.reuse_original:
+                    self.compression_cache.set_original(self.resources[resource_name], data)
+
+    def release(self, resource_names):
+        for resource_name in resource_names:
+            if isinstance(self.resources.get(resource_name), MappedResource):
+                self.resources.pop(resource_name).view.release()
+
+    def forget(self, resource_names):
+        self.release(resource_names)
+        for resource_name in resource_names:
+            self.resources.pop(resource_name, None)
+            self.compressed_resources.pop(resource_name, None)
+            self.compression_keys.pop(resource_name, None)
+
+
+class CompressionCache:
+    def __init__(self, folder, size_limit):
+        self.folder = folder
+        self.size_limit = size_limit
+
+    @staticmethod
+    def get_key(data, settings):
+        hash_ = hashlib.sha256(settings.encode("ASCII"))
+        hash_.update(data)
+        return hash_.hexdigest()
+
+    def get(self, key):
+        path = f"{self.folder}/{key[:2]}/{key}"
+        if not exists(path):
+            return None
+        utime(path)
+        with open(path, "rb") as file:
+            return file.read()
+
+    def set(self, key, data, overwrite=True):
+        path = f"{self.folder}/{key[:2]}/{key}"
+        if not overwrite and exists(path):
+            return
+        makedirs(f"{self.folder}/{key[:2]}", exist_ok=True)
+        with open(f"{path}.{getpid()}.tmp", "wb") as file:
+            file.write(data)
+        if overwrite:
+            replace(f"{path}.{getpid()}.tmp", path)
+            return
+        try:
+            link(f"{path}.{getpid()}.tmp", path)
+        except FileExistsError:
+            pass
+        except OSError:
+            try:
+                with open(path, "xb") as file:
+                    file.write(data)
+            except FileExistsError:
+                pass
+        finally:
+            remove(f"{path}.{getpid()}.tmp")
+
+    def get_original(self, data):
+        compressed_data = self.get(self.get_key(data, AssetReader.ORIGINAL_SETTINGS))
+        if compressed_data is None or struct.unpack_from(">L", compressed_data)[0] != len(data):
+            return None
+        return compressed_data
+
+    def set_original(self, data, compressed_data):
+        self.set(self.get_key(data, AssetReader.ORIGINAL_SETTINGS), compressed_data, False)
+
+    def trim(self):
+        if not exists(self.folder):
+            return
+        entries = []
+        for folder in scandir(self.folder):
+            if folder.is_dir():
+                entries += [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in scandir(folder.path)]
+        cache_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if cache_size <= self.size_limit:
+                break
+            remove(path)
+            cache_size -= size
+
+
+class BuildManifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if exists(path):
+            with open(path, "rt", encoding="UTF-8") as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def get_signature(path):
+        if not exists(path):
+            return None
+        file_stat = stat(path)
+        return [file_stat.st_mtime_ns, file_stat.st_size]
+
+    def is_up_to_date(self, name, inputs, output_path):
+        return self.is_entry_up_to_date(self.entries.get(name), inputs, output_path)
+
+    @staticmethod
+    def is_entry_up_to_date(entry, inputs, output_path):
+        output_signature = BuildManifest.get_signature(output_path)
+        return (entry is not None and output_signature is not None and entry["Inputs"] == inputs and
+                entry["Output"] == output_signature)
+
+    def set(self, name, inputs, output_path):
+        self.entries[name] = self.create_entry(inputs, output_path)
+
+    @staticmethod
+    def create_entry(inputs, output_path):
+        return {"Inputs": inputs, "Output": BuildManifest.get_signature(output_path)}
+
+    def save(self):
+        with open(f"{self.path}.tmp", "wt", encoding="UTF-8") as file:
+            json.dump(self.entries, file)
+        replace(f"{self.path}.tmp", self.path)
+
+
+class Profiler:
+    SUMMARY_SIZE = 10
+    enabled = False
+    trace_memory = False
+    start_time = 0
+    events = []
+    memory_stack = []
+
+    @classmethod
+    def enable(cls, trace_memory=False):
+        cls.enabled = True
+        cls.trace_memory = trace_memory
+        cls.start_time = time.perf_counter_ns()
+        if trace_memory:
+            tracemalloc.start()
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name, category, args=None):
+        args = {} if args is None else args
+        if not cls.enabled:
+            yield args
+            return
+        if cls.trace_memory:
+            cls.enter_memory_stage()
+        start_time = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            end_time = time.perf_counter_ns()
+            if cls.trace_memory:
+                args["Peak allocated"] = cls.exit_memory_stage()
+            cls.events.append({"name": name, "cat": category, "ph": "X", "ts": (start_time - cls.start_time) / 1000,
+                               "dur": (end_time - start_time) / 1000, "pid": getpid(), "tid": 0, "args": args})
+
+    @classmethod
+    def profile(cls, name, category, get_args=lambda *_: {}):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with cls.stage(name, category, get_args(*args) if cls.enabled else None):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def enter_memory_stage(cls):
+        current_size, peak_size = tracemalloc.get_traced_memory()
+        if cls.memory_stack:
+            cls.memory_stack[-1][1] = max(cls.memory_stack[-1][1], peak_size)
+        tracemalloc.reset_peak()
+        cls.memory_stack.append([current_size, current_size])
+
+    @classmethod
+    def exit_memory_stage(cls):
+        start_size, peak_size = cls.memory_stack.pop()
+        peak_size = max(peak_size, tracemalloc.get_traced_memory()[1])
+        if cls.memory_stack:
+            cls.memory_stack[-1][1] = max(cls.memory_stack[-1][1], peak_size)
+        tracemalloc.reset_peak()
+        return peak_size - start_size
+
+    @classmethod
+    def get_summary(cls):
+        stages = {}
+        assets = {}
+        paks = {}
+        for event in cls.events:
+            stage = stages.setdefault(event["name"], {"Count": 0, "Seconds": 0, "Bytes": 0, "Peak allocated": 0})
+            stage["Count"] += 1
+            stage["Seconds"] += event["dur"] / 1000000
+            stage["Bytes"] += event["args"].get("Bytes", 0)
+            stage["Peak allocated"] = max(stage["Peak allocated"], event["args"].get("Peak allocated", 0))
+            if "Asset" in event["args"]:
+                assets[event["args"]["Asset"]] = assets.get(event["args"]["Asset"], 0) + event["dur"] / 1000000
+            if "Pak" in event["args"]:
+                paks[event["args"]["Pak"]] = paks.get(event["args"]["Pak"], 0) + event["dur"] / 1000000
+        return {
+            "Stages": dict(sorted(stages.items(), key=lambda item: -item[1]["Seconds"])),
+            "Slowest paks": dict(sorted(paks.items(), key=lambda item: -item[1])[:cls.SUMMARY_SIZE]),
+            "Slowest assets": dict(sorted(assets.items(), key=lambda item: -item[1])[:cls.SUMMARY_SIZE])
+        }
+
+    @classmethod
+    def save(cls, path):
+        summary = cls.get_summary()
+        with open(path, "wt", encoding="UTF-8") as file:
+            json.dump({"traceEvents": cls.events, "displayTimeUnit": "ms", "summary": summary}, file)
+        print(f"Profile written to {path}\nStages:")
+        for stage_name, stage in summary["Stages"].items():
+            print(f"  {stage_name}: {stage['Seconds']:.6f} seconds in {stage['Count']} calls" +
+                  (f", {stage['Bytes']} bytes" if stage["Bytes"] else "") +
+                  (f", {stage['Peak allocated']} bytes peak allocated" if cls.trace_memory else ""))
+        for title in ["Slowest paks", "Slowest assets"]:
+            if summary[title]:
+                print(f"{title}:")
+            for name, seconds in summary[title].items():
+                print(f"  {name}: {seconds:.6f} seconds")
+
+
+class MappedResource:
+    def __init__(self, view, is_compressed):
+        self.view = view
+        self.is_compressed = is_compressed
+
+    def load(self):
+        return AssetReader.decompress_resource(self.view) if self.is_compressed else self.view
 
 
 class FileReader:
@@ -144,53 +823,67 @@ class FileReader:
         self.offset += size
         return [i for i in data]
 
-    def read_utf16be(self):
-        end_offset = self.bytes.find(b"\x00\x00", self.offset)
-        while (end_offset - self.offset) % 2 != 0 and end_offset != -1:
-            self.offset = self.bytes.find(b"\x00\x00", end_offset)
-        string = self.bytes[self.offset: end_offset].decode("UTF-16BE")
-        self.offset = end_offset
-        return string
-
     def read_ansi(self):
         end_offset = self.bytes.find(b"\x00", self.offset)
         string = self.bytes[self.offset: end_offset].decode("ANSI")
         self.offset = end_offset + 1
         return string
 
-    def read_nibbles(self, count):
-        if count % 2 != 0:
-            raise Exception("File reader can't read odd number of nibbles")
-        nibbles = []
-        for byte, in self.iter_read(">B", count // 2):
-            nibbles.append(byte >> 4)
-            nibbles.append(byte & 15)
-        return nibbles
-
 
 class Pak:
-    def from_pak(self, game_folder, pak_name, resource_reader):
+    EXTRACTION_CHUNK_SIZE = 8 * 1024 * 1024
+
+    @Profiler.profile("Read pak", "Pak", lambda _, game_folder, pak_name, *__: {
+        "Pak": pak_name, "Bytes": stat(f"{game_folder}/{pak_name}.pak").st_size})
+    def from_pak(self, game_folder, pak_name, resource_reader, memory_map=False, index_folder=None):
         self.name = pak_name
         with open(f"{game_folder}/{pak_name}.pak", "rb") as file:
-            reader = FileReader(file.read())
-        if reader.read(">2HL") != (3, 5, 0):
-            raise Exception(f"Invalid HEADER in pak {pak_name}")
-        self.asset_names = {}
-        for _ in range(reader.read(">L")[0]):
-            asset_type, asset_id, asset_name_length = reader.read(">4s2L")
-            asset_name = reader.read(f">{asset_name_length}s")[0].decode("ANSI")
-            self.asset_names[asset_name] = f"{hex(asset_id)[2:].upper().rjust(8, '0')}.{asset_type.decode('ANSI')}"
-        self.assets = []
-        for _ in range(reader.read(">L")[0]):
-            compression_flag, asset_type, asset_id, asset_size, asset_offset = reader.read(">L4s3L")
-            self.assets.append(
-                Asset(asset_type.decode("ANSI"), hex(asset_id)[2:].upper().rjust(8, '0'), compression_flag != 0,
-                      resource_reader)
-            )
-            resource_reader.set_raw_data(self.assets[-1].name, reader.bytes[asset_offset: asset_offset + asset_size],
-                                         self.assets[-1].is_compressed)
+            if memory_map:
+                self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                reader = FileReader(memoryview(self.mapping))
+            else:
+                reader = FileReader(file.read())
+        index = (PakIndex().from_reader(reader, pak_name) if index_folder is None
+                 else PakIndex().from_pak(f"{game_folder}/{pak_name}.pak", index_folder))
+        self.from_index(pak_name, index, resource_reader)
+        for asset, (asset_offset, asset_size) in zip(self.assets, self.asset_locations):
+            resource_reader.set_raw_data(asset.name, reader.bytes[asset_offset: asset_offset + asset_size],
+                                         asset.is_compressed, memory_map)
+        if memory_map:
+            reader.bytes.release()
+        return self
+
+    def from_index(self, pak_name, index, resource_reader):
+        self.name = pak_name
+        self.asset_names = index.asset_names
+        self.assets = [Asset(entry["Type"], entry["ID"], entry["Compressed"], resource_reader)
+                       for entry in index.assets]
+        self.asset_locations = [(entry["Offset"], entry["Size"]) for entry in index.assets]
         return self
 
+    @staticmethod
+    def extract_assets(pak_path, assets, folder, original_cache=None):
+        start_time = time.time()
+        digests = []
+        with open(pak_path, "rb") as file:
+            for asset_name, asset_offset, asset_size, is_compressed, is_written in assets:
+                file.seek(asset_offset)
+                data = file.read(asset_size)
+                if is_compressed:
+                    compressed_data, data = data, AssetReader.decompress_resource(data)
+                    if original_cache is not None:
+                        original_cache.set_original(data, compressed_data)
+                if is_written:
+                    with open(f"{folder}/{asset_name}", "wb") as asset_file:
+                        asset_file.write(data)
+                digests.append((asset_name, AssetStore.get_digest(data)))
+        return start_time, time.time(), digests
+
+    def close(self, resource_reader):
+        resource_reader.release([asset.name for asset in self.assets])
+        self.mapping.close()
+
+    @Profiler.profile("Read files", "Pak", lambda _, pak_name, *__: {"Pak": pak_name})
     def from_files_config(self, pak_name, resource_reader, pak_config):
         self.name = pak_name
         self.asset_names = pak_config["Names"]
@@ -200,40 +893,184 @@ class Pak:
             resource_reader.read_file(f"{asset['ID']}.{asset['Type']}")
         return self
 
+    @Profiler.profile("Write pak", "Pak", lambda self, *_: {"Pak": self.name})
     def save_as_pak(self, game_folder, resource_reader):
-        header = struct.pack(">2HL", 3, 5, 0)
-        name_table = struct.pack(">L", len(self.asset_names))
-        for name in self.asset_names:
-            id_, type_ = self.asset_names[name].split(".")
-            name_table += type_.encode("ANSI") + struct.pack(">LL", int(id_, 16), len(name)) + name.encode("ANSI")
-        asset_table = struct.pack(">L", len(self.assets))
-        asset_offset = len(header) + len(name_table) + 4 + 20 * len(self.assets)
-        assets = b"\x00" * (-asset_offset % 32)
-        asset_offset += len(assets)
-        for asset in self.assets:
-            asset_data = resource_reader.get(asset.name, True, asset.is_compressed)
-            asset_table += struct.pack(">L4s3L", 1 if asset.is_compressed else 0, asset.type.encode("ANSI"),
-                                       int(asset.id, 16), len(asset_data), asset_offset)
-            assets += asset_data
-            asset_offset += len(asset_data)
+        names = [(name.encode("ANSI"), *self.asset_names[name].split(".")) for name in self.asset_names]
+        name_table_offset = 8
+        asset_table_offset = name_table_offset + 4 + sum(12 + len(name) for name, _, _ in names)
+        tables = bytearray(asset_table_offset + 4 + 20 * len(self.assets))
+        struct.pack_into(">2HL", tables, 0, 3, 5, 0)
+        struct.pack_into(">L", tables, name_table_offset, len(names))
+        offset = name_table_offset + 4
+        for name, id_, type_ in names:
+            struct.pack_into(f">4s2L{len(name)}s", tables, offset, type_.encode("ANSI"), int(id_, 16), len(name), name)
+            offset += 12 + len(name)
+        struct.pack_into(">L", tables, asset_table_offset, len(self.assets))
+        asset_offset = len(tables) + (-len(tables) % 32)
         with open(f"{game_folder}/{self.name}.pak", "wb") as file:
-            file.write(header + name_table + asset_table + assets)
-
-    def save_as_files_config(self, folder):
-        if not exists(f"{folder}/files"):
-            makedirs(f"{folder}/files")
+            file.write(tables)
+            file.write(b"\x00" * (asset_offset - len(tables)))
+            for asset_index, asset in enumerate(self.assets):
+                asset_data = resource_reader.get(asset.name, False, asset.is_compressed)
+                padding = -len(asset_data) % 32
+                if asset_offset + len(asset_data) + padding > AssetReader.MAX_SIZE:
+                    raise Exception(f"Pak {self.name} doesn't fit into the 4 GiB the asset table can address "
+                                    f"(at asset {asset.name})")
+                file.write(asset_data)
+                file.write(b"\xFF" * padding)
+                struct.pack_into(">L4s3L", tables, asset_table_offset + 4 + 20 * asset_index,
+                                 1 if asset.is_compressed else 0, asset.type.encode("ANSI"), int(asset.id, 16),
+                                 len(asset_data) + padding, asset_offset)
+                asset_offset += len(asset_data) + padding
+            file.seek(0)
+            file.write(tables)
+
+    @Profiler.profile("Write files", "Pak", lambda self, *_: {"Pak": self.name})
+    def save_as_files(self, asset_store):
         for asset in self.assets:
-            asset.save(f"{folder}/files/{asset.id}.{asset.type}")
-        with open(f"{folder}/{self.name}.yaml", "wt") as file:
-            file.write(yaml.dump(self.get_info(), sort_keys=False))
-
-    def get_info(self):
+            asset_store.add(asset.name, self.name, asset.resource_reader.get(asset.name, False))
+
+    @Profiler.profile("Write config", "Pak", lambda self, *_: {"Pak": self.name})
+    def save_config(self, folder, asset_store=None, formats=("yaml",)):
+        import yaml
+        info = self.get_info(asset_store)
+        if "yaml" in formats:
+            with open(f"{folder}/{self.name}.yaml", "wt") as file:
+                file.write(yaml.dump(info, sort_keys=False, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper)))
+        if "json" in formats:
+            with open(f"{folder}/{self.name}.json", "wt", encoding="UTF-8") as file:
+                json.dump(info, file, ensure_ascii=False)
+
+    def get_info(self, asset_store=None):
+        assets_info = []
+        for asset in self.assets:
+            assets_info.append(asset.get_info())
+            if asset_store is not None and asset_store.get_other_paks(asset.name, self.name):
+                assets_info[-1]["Shared with"] = asset_store.get_other_paks(asset.name, self.name)
         return {
             "Names": self.asset_names,
-            "Assets info": [asset.get_info() for asset in self.assets]
+            "Assets info": assets_info
         }
 
 
+class AssetStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.paks = {}
+        self.digests = {}
+        self.conflicts = {}
+
+    @staticmethod
+    def get_digest(data):
+        # Only the alignment padding an uncompressed copy may carry is ignored
+        padding = bytes(memoryview(data)[-31:])
+        end = len(data) - len(padding) + len(padding.rstrip(b"\xFF"))
+        return hashlib.sha256(memoryview(data)[:end]).hexdigest()
+
+    def register(self, asset_name, pak_name):
+        if asset_name not in self.paks:
+            self.paks[asset_name] = [pak_name]
+            return True
+        if pak_name not in self.paks[asset_name]:
+            self.paks[asset_name].append(pak_name)
+        return False
+
+    def check(self, asset_name, pak_name, digest):
+        if asset_name not in self.digests:
+            self.digests[asset_name] = digest
+        elif self.digests[asset_name] != digest:
+            self.conflicts.setdefault(asset_name, []).append(pak_name)
+
+    def add(self, asset_name, pak_name, data):
+        if self.register(asset_name, pak_name):
+            with open(f"{self.folder}/{asset_name}", "wb") as file:
+                file.write(data)
+        self.check(asset_name, pak_name, self.get_digest(data))
+
+    def get_other_paks(self, asset_name, pak_name):
+        return [name for name in self.paks[asset_name] if name != pak_name]
+
+    def report_conflicts(self):
+        for asset_name, pak_names in self.conflicts.items():
+            print(f"Conflicting copies of {asset_name}: kept the one from pak {self.paks[asset_name][0]}, "
+                  f"different bytes in pak(s) {', '.join(pak_names)}")
+
+
+class PakIndex:
+    def from_pak(self, path, index_folder=None):
+        self.path = path
+        signature = BuildManifest.get_signature(path)
+        index_path = None
+        if index_folder is not None:
+            index_path = f"{index_folder}/{hashlib.sha256(abspath(path).encode('UTF-8')).hexdigest()[:32]}.json"
+            if exists(index_path):
+                with open(index_path, "rt", encoding="UTF-8") as file:
+                    index = json.load(file)
+                if index["Signature"] == signature:
+                    return self.from_dict(index)
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                self.from_reader(FileReader(mapping), path)
+        if index_path is not None:
+            if not exists(index_folder):
+                makedirs(index_folder)
+            with open(index_path, "wt", encoding="UTF-8") as file:
+                json.dump(self.get_dict(signature), file)
+        return self
+
+    @Profiler.profile("Parse tables", "PakIndex")
+    def from_reader(self, reader, pak_name):
+        if reader.read(">2HL") != (3, 5, 0):
+            raise Exception(f"Invalid HEADER in pak {pak_name}")
+        self.asset_names = {}
+        for _ in range(reader.read(">L")[0]):
+            asset_type, asset_id, asset_name_length = reader.read(">4s2L")
+            asset_name = reader.read(f">{asset_name_length}s")[0].decode("ANSI")
+            self.asset_names[asset_name] = f"{hex(asset_id)[2:].upper().rjust(8, '0')}.{asset_type.decode('ANSI')}"
+        self.assets = []
+        for _ in range(reader.read(">L")[0]):
+            compression_flag, asset_type, asset_id, asset_size, asset_offset = reader.read(">L4s3L")
+            self.assets.append({"ID": hex(asset_id)[2:].upper().rjust(8, '0'), "Type": asset_type.decode("ANSI"),
+                                "Compressed": compression_flag != 0, "Offset": asset_offset, "Size": asset_size})
+        self.build_lookup()
+        return self
+
+    def from_dict(self, dict_):
+        self.asset_names = dict_["Names"]
+        self.assets = dict_["Assets"]
+        self.build_lookup()
+        return self
+
+    def get_dict(self, signature):
+        return {"Signature": signature, "Names": self.asset_names, "Assets": self.assets}
+
+    def build_lookup(self):
+        self.assets_by_name = {}
+        self.assets_by_id = {}
+        for entry in self.assets:
+            self.assets_by_name.setdefault(f"{entry['ID']}.{entry['Type']}", entry)
+            self.assets_by_id.setdefault(entry["ID"], entry)
+
+    def find(self, key):
+        key = self.asset_names.get(key, key)
+        entry = self.assets_by_name.get(key.upper()) or self.assets_by_id.get(key.upper().rjust(8, "0"))
+        if entry is None:
+            raise KeyError(f"No asset {key} in pak {self.path}")
+        return entry
+
+    def get_entries(self, types=None):
+        return [entry for entry in self.assets if types is None or entry["Type"] in types]
+
+    def read(self, key, file=None):
+        entry = self.find(key) if isinstance(key, str) else key
+        if file is None:
+            with open(self.path, "rb") as file:
+                return self.read(entry, file)
+        file.seek(entry["Offset"])
+        data = file.read(entry["Size"])
+        return AssetReader.decompress_resource(data) if entry["Compressed"] else data
+
+
 class Asset:
     def __init__(self, type_, id_, is_compressed, resource_reader):
         self.type = type_
@@ -249,10 +1086,6 @@ class Asset:
             "Compressed": self.is_compressed
         }
 
-    def save(self, path):
-        with open(path, "wb") as file:
-            file.write(self.resource_reader.get(self.name, False))
-
 
 class Strg:
     MAGIC = 0x87654321
@@ -263,78 +1096,107 @@ class Strg:
         self.strings = {}
 
     def open_strg(self, path):
-        self.id = path.split("/")[-1].split(".")[0]
         with open(path, "rb") as file:
-            reader = FileReader(file.read())
-        magic, self.version = reader.read(">2L")
+            return self.from_bytes(path.split("/")[-1].split(".")[0], file.read())
+
+    @Profiler.profile("Parse STRG", "Strg", lambda _, id_, data: {"Asset": f"{id_}.STRG", "Bytes": len(data)})
+    def from_bytes(self, id_, data):
+        self.id = id_
+        magic, self.version, language_count, string_count = struct.unpack_from(">4L", data)
         if magic != self.MAGIC:
-            raise Exception(f"Wrong MAGIC in file {path}. File MAGIC is {magic} and required to be {self.MAGIC}.")
+            raise Exception(f"Wrong MAGIC in STRG {self.id}. File MAGIC is {magic} and required to be {self.MAGIC}.")
         if self.version > 0:
-            raise Exception(f"Unsupported VERSION in file {path}")
-        language_count, string_count = reader.read(">2L")
-        language_table = {}
-        for language_id, language_offset in reader.iter_read(">4sL", language_count):
-            language_table[language_id] = language_offset
-        strings_start_offset = reader.offset
-        for language in language_table:
-            reader.offset = strings_start_offset + language_table[language] + 4
-            language_strings_offset = reader.offset
-            string_offsets = reader.iter_read(">L", string_count)
-            self.strings[language] = []
-            for string_offset in string_offsets:
-                reader.offset = language_strings_offset + string_offset[0]
-                self.strings[language].append(reader.read_utf16be())
+            raise Exception(f"Unsupported VERSION in STRG {self.id}")
+        language_table = struct.unpack_from(">" + "4sL" * language_count, data, 16)
+        strings_start_offset = 16 + 8 * language_count
+        view = memoryview(data)
+        for language, language_offset in zip(language_table[0::2], language_table[1::2]):
+            string_table_offset = strings_start_offset + language_offset + 4
+            self.strings[language] = [self.decode_string(data, view, string_table_offset + string_offset)
+                                      for string_offset in struct.unpack_from(f">{string_count}L", data,
+                                                                              string_table_offset)]
         return self
 
+    @staticmethod
+    def decode_string(data, view, offset):
+        end_offset = data.find(b"\x00\x00", offset)
+        while (end_offset - offset) % 2 != 0 and end_offset != -1:
+            end_offset = data.find(b"\x00\x00", end_offset + 1)
+        return str(view[offset: end_offset], "UTF-16BE")
+
     def save_as_strg(self, path):
+        buffer = self.get_bytes()
+        with open(path, "wb") as file:
+            file.write(buffer)
+
+    @Profiler.profile("Encode STRG", "Strg", lambda self: {"Asset": f"{self.id.removeprefix('0x')}.STRG"})
+    def get_bytes(self):
         if self.version > 0:
             raise Exception(f"Unsupported VERSION")
-        header = struct.pack(">4L", self.MAGIC, self.version, len(self.strings), self.strings_count)
-        language_table = b""
-        string_table = b""
-        language_offset = 0
+        string_count = self.strings_count
+        string_tables = []
         for language in self.strings:
-            string_offsets = b""
-            strings = b""
-            string_offset = len(self.strings[language]) * 4
-            for string in [string.encode("UTF-16BE") + b"\x00\x00" for string in self.strings[language]]:
-                string_offsets += struct.pack(">L", string_offset)
-                strings += string
-                string_offset += len(string)
-            string_table_size = len(string_offsets) + len(strings)
-            string_table += struct.pack(">L", string_table_size) + string_offsets + strings
-            language_table += language.encode("ASCII") + struct.pack(">L", language_offset)
+            strings = [string.encode("UTF-16BE") + b"\x00\x00" for string in self.strings[language]]
+            string_offsets = list(accumulate([len(string) for string in strings], initial=len(strings) * 4))
+            string_tables.append((language, string_offsets[:-1], b"".join(strings)))
+        string_table_offset = 16 + 8 * len(string_tables)
+        buffer = bytearray(string_table_offset + sum(4 + 4 * string_count + len(strings)
+                                                     for _, _, strings in string_tables))
+        struct.pack_into(">4L", buffer, 0, self.MAGIC, self.version, len(string_tables), string_count)
+        language_offset = 0
+        for language_index, (language, string_offsets, strings) in enumerate(string_tables):
+            string_table_size = len(string_offsets) * 4 + len(strings)
+            struct.pack_into(">4sL", buffer, 16 + 8 * language_index, language.encode("ASCII"), language_offset)
+            struct.pack_into(f">L{len(string_offsets)}L", buffer, string_table_offset + language_offset,
+                             string_table_size, *string_offsets)
+            strings_offset = string_table_offset + language_offset + 4 + len(string_offsets) * 4
+            buffer[strings_offset: strings_offset + len(strings)] = strings
             language_offset += 4 + string_table_size
-        buffer = header + language_table + string_table
-        with open(path, "wb") as file:
-            file.write(buffer)
-    
+        return buffer
+
     @staticmethod
     def from_csv(path, overwrite_languages):
-        with open(path, "rt", encoding="UTF-8") as file:
-            raw_data = [i for i in csv.reader(file, dialect="unix")]
         overwrite_languages = {languages.split("2")[0]: languages.split("2")[1] for languages in overwrite_languages}
-        version = int(raw_data[0][0].split("=")[-1])
-        raw_data = raw_data[1:]
-        strgs = []
-        languages = None
-        for row_index, row in enumerate(raw_data[: -2]):
-            if Strg._is_row_empty(raw_data[row_index - 1]):
-                languages = Strg._rip_empty_languages(row[1:])
-                strgs.append(Strg(row[0], version))
-                strgs[-1].strings = {language: [] for language in languages
-                                     if language not in overwrite_languages
-                                     or language in overwrite_languages.values()}
-            elif not Strg._is_row_empty(row):
-                for column_index, cell in enumerate(row[1: len(languages) + 1]):
-                    language = languages[column_index]
-                    if language in overwrite_languages:
-                        strgs[-1].strings[overwrite_languages[language]].append(cell)
-                    elif language not in overwrite_languages.values():
-                        strgs[-1].strings[language].append(cell)
-                if [] in strgs[-1].strings.values():
-                    print(strgs[-1].id, strgs[-1].strings)
-        return strgs
+        with open(path, "rt", encoding="UTF-8") as file:
+            rows = csv.reader(file, dialect="unix")
+            version = int(next(rows)[0].split("=")[-1])
+            strg = None
+            languages = None
+            is_previous_row_empty = True
+            for row in Strg._drop_last_rows(rows, 2):
+                is_row_empty = Strg._is_row_empty(row)
+                if is_previous_row_empty and not is_row_empty:
+                    if strg is not None:
+                        yield Strg._check_empty_languages(strg)
+                    languages = Strg._rip_empty_languages(row[1:])
+                    strg = Strg(row[0], version)
+                    strg.strings = {language: [] for language in languages
+                                    if language not in overwrite_languages
+                                    or language in overwrite_languages.values()}
+                elif not is_row_empty:
+                    for column_index, cell in enumerate(row[1: len(languages) + 1]):
+                        language = languages[column_index]
+                        if language in overwrite_languages:
+                            strg.strings[overwrite_languages[language]].append(cell)
+                        elif language not in overwrite_languages.values():
+                            strg.strings[language].append(cell)
+                is_previous_row_empty = is_row_empty
+            if strg is not None:
+                yield Strg._check_empty_languages(strg)
+
+    @staticmethod
+    def _drop_last_rows(rows, count):
+        buffer = deque()
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) > count:
+                yield buffer.popleft()
+
+    @staticmethod
+    def _check_empty_languages(strg):
+        if [] in strg.strings.values():
+            print(strg.id, strg.strings)
+        return strg
 
     @staticmethod
     def _rip_empty_languages(langs):
@@ -348,6 +1210,7 @@ class Strg:
         return True
 
     @staticmethod
+    @Profiler.profile("Write CSV", "Strg", lambda path, strgs, *_: {"Path": path, "STRGs": len(strgs)})
     def save_as_csv(path, strgs, additional_langs=None):
         if additional_langs is None:
             additional_langs = []
@@ -376,56 +1239,138 @@ class Strg:
 
 class Font:
     MAGIC = 0x464F4E54
+    GLYPH_FILE_NAME = re.compile("(?:U\\+)?([0-9A-F]{1,6})\\.PNG")
 
-    def from_font_txtr(self, path):
+    def from_font_txtr(self, path, with_texture=True):
         resource_folder = "/".join(path.split("/")[: -1])
         self.file_name = path.split("/")[-1]
-        self.id = ".".join(self.file_name.split('.')[:-1]).upper()
+
+        def load_texture(texture_id):
+            if not with_texture:
+                return None
+            return FontTxtr().from_txtr(f"{resource_folder}/{texture_id.upper().rjust(8, '0')}.TXTR")
+
         with open(path, "rb") as file:
-            reader = FileReader(file.read())
+            return self.from_bytes(".".join(self.file_name.split('.')[:-1]).upper(), file.read(), load_texture)
+
+    @Profiler.profile("Parse FONT", "Font", lambda _, id_, data, __: {"Asset": f"{id_}.FONT", "Bytes": len(data)})
+    def from_bytes(self, id_, data, load_texture):
+        self.id = id_
+        reader = FileReader(data)
         magic, self.version = reader.read(">LL")
         if magic != self.MAGIC:
-            raise Exception(f"Wrong MAGIC in file {path}. File MAGIC is {magic} and required to be {self.MAGIC}.")
+            raise Exception(f"Wrong MAGIC in FONT {self.id}. File MAGIC is {magic} and required to be {self.MAGIC}.")
         if self.version == 4:
             (self.width, self.height, self.vertical_offset, self.line_margin,
                 self.tmp1, self.tmp2, self.tmp3, self.font_size) = reader.read(">4L2?2L")
             self.font_name = reader.read_ansi()
             texture_id, self.texture_mode, glyph_count = reader.read(">3L")
             self.texture_id = hex(texture_id)[2:]
-            self.texture = FontTxtr().from_txtr(f"{resource_folder}/{self.texture_id}.TXTR")
-            self.glyphs = [FontGlyph().from_data(*i[:11], self.texture.size)
-                           for i in reader.iter_read(">H4f7BH", glyph_count)]
+            self.texture = load_texture(self.texture_id)
+            self.glyphs = [FontGlyph().from_data(*i[:12], None if self.texture is None else self.texture.size)
+                           for i in reader.iter_read(">H4fB3b3BH", glyph_count)]
             self.kerning = {self.decode_character(i[0]) + self.decode_character(i[1]): i[2]
                             for i in reader.iter_read(">2Hl", reader.read(">L")[0])}
         else:
             raise Exception("Unsupported version")
         return self
 
-    def from_yaml_pngs(self, folder):
+    @Profiler.profile("Read YAML and PNGs", "Font", lambda _, folder, *__: {"Path": folder})
+    def from_yaml_pngs(self, folder, glyph_cache_folder=None, charset=None, subset=False):
+        import yaml
         with open(f"{folder}/Font.yaml", "rt", encoding="UTF-8") as file:
             dict_ = yaml.safe_load(file)
+        if subset and charset is not None:
+            self.texture = self.layout_glyphs(folder, dict_, glyph_cache_folder,
+                                              charset.get_characters(dict_.get("Languages")) |
+                                              set(dict_.get("Keep characters", "")),
+                                              charset.get_pairs(dict_.get("Languages")))
+        elif exists(f"{folder}/Glyphs") or "Generate" in dict_:
+            self.texture = self.layout_glyphs(folder, dict_, glyph_cache_folder)
+        else:
             self.texture = FontTxtr().from_pngs(folder, dict_["Texture palette"])
-            self.from_dict(dict_, self.texture.size)
+        self.from_dict(dict_, self.texture.size)
+        if charset is not None:
+            charset.report_missing(self.id, {glyph.character for glyph in self.glyphs}, dict_.get("Languages"))
         return self
 
+    @staticmethod
+    def layout_glyphs(folder, dict_, glyph_cache_folder=None, characters=None, pairs=None):
+        bitmaps = {}
+        texture_size = dict_.get("Texture size")
+        if exists(f"{folder}/Layer 0.png"):
+            texture = FontTxtr().from_pngs(folder, dict_["Texture palette"])
+            texture_size = texture_size or list(texture.size)
+            layers = texture.get_layers()
+            for character, glyph_dict in dict_["Glyphs"].items():
+                if "Left" in glyph_dict:
+                    bitmaps[character] = layers[glyph_dict["Layer"]][int(glyph_dict["Top"]): int(glyph_dict["Bottom"]),
+                                                                     int(glyph_dict["Left"]): int(glyph_dict["Right"])]
+        if "Generate" in dict_:
+            Font.generate_glyphs(folder, dict_, bitmaps, glyph_cache_folder)
+        for file_name in listdir(f"{folder}/Glyphs") if exists(f"{folder}/Glyphs") else []:
+            match = Font.GLYPH_FILE_NAME.fullmatch(file_name.upper())
+            if match is None or int(match[1], 16) > 0x10FFFF:
+                if file_name.lower().endswith(".png"):
+                    print(f"({dict_['ID']}) Skipping {file_name}, glyph PNGs are named by code point like 0416.png")
+                continue
+            character = chr(int(match[1], 16))
+            bitmaps[character] = FontTxtr.load_layer(f"{folder}/Glyphs/{file_name}")
+            dict_["Glyphs"].setdefault(character, {"Padding": 0})
+        for character in dict_["Glyphs"]:
+            if character not in bitmaps:
+                raise Exception(f"({dict_['ID']}) No bitmap for glyph {character}")
+        if texture_size is None:
+            raise Exception(f"({dict_['ID']}) Set \"Texture size\" to lay out glyphs without layer PNGs")
+        if characters is not None:
+            dict_["Glyphs"] = {character: dict_["Glyphs"][character] for character in dict_["Glyphs"]
+                               if character in characters}
+            bitmaps = {character: bitmaps[character] for character in dict_["Glyphs"]}
+            dict_["Kerning"] = {pair: kerning for pair, kerning in dict_["Kerning"].items() if pair in pairs}
+        dict_["Glyphs"] = dict(sorted(dict_["Glyphs"].items(), key=lambda item: ord(item[0])))
+        atlas = GlyphAtlas(texture_size, dict_.get("Glyph spacing", 1))
+        if characters is not None:
+            texture_size = atlas.shrink(bitmaps)
+        placements = atlas.pack(bitmaps)
+        for character, (layer_index, x, y) in placements.items():
+            dict_["Glyphs"][character].update({"Left": x, "Top": y, "Right": x + bitmaps[character].shape[1],
+                                               "Bottom": y + bitmaps[character].shape[0], "Layer": layer_index})
+        return FontTxtr().from_layers(texture_size, dict_["Texture palette"], atlas.render(bitmaps, placements))
+
+    @staticmethod
+    def generate_glyphs(folder, dict_, bitmaps, glyph_cache_folder=None):
+        settings = dict_["Generate"]
+        font_path = settings["Font file"] if isabs(settings["Font file"]) else f"{folder}/{settings['Font file']}"
+        rasterizer = GlyphRasterizer(font_path, settings.get("Size", dict_["Font size"]),
+                                     settings.get("Threshold", 128), glyph_cache_folder)
+        dict_.setdefault("Glyphs", {})
+        for character, (bitmap, metrics) in rasterizer.rasterize(GlyphRasterizer.get_characters(settings)).items():
+            if character not in dict_["Glyphs"]:
+                bitmaps[character] = bitmap
+                dict_["Glyphs"][character] = metrics
+
+    @Profiler.profile("Write FONT", "Font", lambda self, _: {"Asset": f"{self.id}.FONT"})
     def save_as_font_strg(self, resource_folder):
         if self.version == 4:
             buffer = struct.pack(">2L4L2?2L", self.MAGIC, self.version, self.width, self.height, self.vertical_offset,
                                  self.line_margin, self.tmp1, self.tmp2, self.tmp3, self.font_size)
             buffer += self.font_name.encode("ANSI") + b"\x00"
             buffer += struct.pack(">LLL", int(self.texture_id, 16), self.texture_mode, len(self.glyphs))
-            for glyph in self.glyphs:
-                buffer += glyph.get_bytes(self.kerning, self.version)
-            buffer += struct.pack(">L", len(self.kerning))
-            for character_pair in self.kerning:
-                buffer += self.encode_character(character_pair) + struct.pack(">l", self.kerning[character_pair])
+            kerning_index = KerningIndex(self.kerning)
+            kerning_index.validate(self.id, [glyph.character for glyph in self.glyphs])
+            buffer += b"".join(glyph.get_bytes(kerning_index, self.version) for glyph in self.glyphs)
+            buffer += struct.pack(">L", len(kerning_index.pairs))
+            buffer += b"".join(self.encode_character(character_pair) + struct.pack(">l", kerning)
+                               for character_pair, kerning in kerning_index.pairs)
         else:
             raise Exception("Unsupported version")
-        self.texture.save_as_txtr(f"{resource_folder}/{self.texture_id}.TXTR")
+        self.texture.save_as_txtr(f"{resource_folder}/{self.texture_id.upper().rjust(8, '0')}.TXTR")
         with open(f"{resource_folder}/{self.id}.FONT", "wb") as file:
             file.write(buffer)
 
+    @Profiler.profile("Write YAML and PNGs", "Font", lambda _, folder: {"Path": folder})
     def save_as_yaml_pngs(self, folder):
+        import yaml
         with open(f"{folder}/Font.yaml", "wt", encoding="UTF-8") as file:
             yaml.dump(self.get_dict(), file, sort_keys=False, allow_unicode=True)
             self.texture.save_as_pngs(folder)
@@ -481,8 +1426,9 @@ class FontGlyph:
         self.character = Font.decode_character(character)
         self.top_left_uv = [left, top]
         self.bottom_right_uv = [right, bottom]
-        self.top_left_xy = self.translate_uv_to_xy(self.top_left_uv, texture_size)
-        self.bottom_right_xy = self.translate_uv_to_xy(self.bottom_right_uv, texture_size)
+        self.top_left_xy = None if texture_size is None else self.translate_uv_to_xy(self.top_left_uv, texture_size)
+        self.bottom_right_xy = (None if texture_size is None
+                                else self.translate_uv_to_xy(self.bottom_right_uv, texture_size))
         self.layer_index = layer_index
         self.padding = [left_padding, right_padding]
         self.print_head_advance = print_head_advance
@@ -505,14 +1451,14 @@ class FontGlyph:
         self.vertical_offset = dict_["Vertical offset"] if "Vertical offset" in dict_ else self.size[1]
         return self
 
-    def get_bytes(self, kerning, version):
+    def get_bytes(self, kerning_index, version):
         buffer = self.character.encode("UTF-16BE")
         buffer += struct.pack(">4f", self.top_left_uv[0], self.top_left_uv[1],
                               self.bottom_right_uv[0], self.bottom_right_uv[1])
         if version >= 4:
             buffer += struct.pack(">B", self.layer_index)
         buffer += struct.pack(">3b3BH", self.padding[0], self.print_head_advance, self.padding[1], self.size[0],
-                              self.size[1], self.vertical_offset, self.get_kerning_start_index(self.character, kerning))
+                              self.size[1], self.vertical_offset, kerning_index.get_start_index(self.character))
         return buffer
 
     def get_dict(self):
@@ -546,12 +1492,213 @@ class FontGlyph:
     def translate_xy_to_uv(xy, texture_size):
         return [xy[0] / texture_size[0], xy[1] / texture_size[1]]
 
+
+class KerningIndex:
+    def __init__(self, kerning):
+        groups = {}
+        for character_pair, kerning_ in kerning.items():
+            groups.setdefault(character_pair[0], []).append((character_pair, kerning_))
+        self.pairs = [pair for group in groups.values() for pair in group]
+        self.start_indexes = {}
+        for index, (character_pair, _) in enumerate(self.pairs):
+            self.start_indexes.setdefault(character_pair[0], index)
+
+    def get_start_index(self, character):
+        return self.start_indexes.get(character, len(self.pairs) + 1)
+
+    def validate(self, font_id, characters):
+        characters = set(characters)
+        for character_pair, _ in self.pairs:
+            if len(character_pair) != 2:
+                raise Exception(f"({font_id}) Kerning pair {character_pair} must have exactly 2 characters")
+            if character_pair[0] not in characters or character_pair[1] not in characters:
+                print(f"({font_id}) Kerning pair {character_pair} uses a character without glyph")
+
+
+class Charset:
+    MARKUP = re.compile("&[^;]*;")
+    PAIR_TABLE_SIZE_LIMIT = 1 << 27
+
+    def __init__(self):
+        self.characters = {}
+        self.pairs = {}
+
+    @Profiler.profile("Analyze charset", "Charset")
+    def from_strgs(self, strgs):
+        texts = {}
+        for strg in strgs:
+            for language, strings in strg.strings.items():
+                texts.setdefault(language, []).extend(strings)
+        for language, strings in texts.items():
+            self.characters[language], self.pairs[language] = self.index_text(self.MARKUP.sub("", "\n".join(strings)))
+        return self
+
+    def index_text(self, text):
+        import numpy
+        code_points = numpy.frombuffer(text.encode("UTF-32-LE"), numpy.uint32)
+        alphabet = numpy.flatnonzero(numpy.bincount(code_points))
+        indexes = numpy.zeros(alphabet[-1] + 1, numpy.int64) if len(alphabet) else numpy.zeros(0, numpy.int64)
+        indexes[alphabet] = numpy.arange(len(alphabet))
+        pair_indexes = indexes[code_points[:-1]] * len(alphabet) + indexes[code_points[1:]]
+        if len(alphabet) ** 2 <= self.PAIR_TABLE_SIZE_LIMIT:
+            is_pair_used = numpy.zeros(len(alphabet) ** 2, bool)
+            is_pair_used[pair_indexes] = True
+            pair_indexes = numpy.flatnonzero(is_pair_used)
+        else:
+            pair_indexes = numpy.unique(pair_indexes)
+        characters = [chr(code_point) for code_point in alphabet.tolist()]
+        pairs = (characters[pair_index // len(alphabet)] + characters[pair_index % len(alphabet)]
+                 for pair_index in pair_indexes.tolist())
+        return ({character for character in characters if character >= " "},
+                {pair for pair in pairs if pair[0] >= " " and pair[1] >= " "})
+
+    def get_characters(self, languages=None):
+        return set().union(*(self.characters.get(language, set()) for language in languages or self.characters))
+
+    def get_pairs(self, languages=None):
+        return set().union(*(self.pairs.get(language, set()) for language in languages or self.pairs))
+
+    def report_missing(self, font_id, characters, languages=None):
+        for language in languages or self.characters:
+            missing_characters = sorted(self.characters.get(language, set()) - characters)
+            if missing_characters:
+                print(f"({font_id}) No glyphs for {len(missing_characters)} characters used in {language}: "
+                      f"{''.join(missing_characters)}")
+
+
+class TextLayout:
+    def __init__(self, font):
+        import numpy
+        glyphs = [glyph for glyph in font.glyphs if glyph.character != "\n"]
+        self.glyph_indexes = self.index_characters([glyph.character for glyph in glyphs])
+        self.advances = numpy.array([0] + [glyph.padding[0] + glyph.print_head_advance + glyph.padding[1]
+                                           for glyph in glyphs], numpy.int64)
+        kerning_characters = sorted({character for pair in font.kerning for character in pair})
+        self.kerning_indexes = self.index_characters(kerning_characters)
+        self.kerning_size = len(kerning_characters) + 1
+        self.kerning = numpy.zeros(self.kerning_size ** 2, numpy.int64)
+        for pair, kerning in font.kerning.items():
+            self.kerning[self.kerning_indexes[ord(pair[0])] * self.kerning_size +
+                         self.kerning_indexes[ord(pair[1])]] = kerning
+        self.line_height = font.height + font.line_margin
+        self.line_margin = font.line_margin
+
     @staticmethod
-    def get_kerning_start_index(character, kerning):
-        try:
-            return [kern[0] for kern in kerning].index(character)
-        except ValueError:
-            return len(kerning) + 1
+    def index_characters(characters):
+        import numpy
+        code_points = [ord(character) for character in characters]
+        indexes = numpy.zeros(max(code_points, default=0) + 2, numpy.intp)
+        indexes[code_points] = numpy.arange(1, len(code_points) + 1)
+        return indexes
+
+    def get_max_lines(self, box):
+        if "Lines" in box:
+            return box["Lines"]
+        return max(1, (box["Height"] + self.line_margin) // self.line_height)
+
+    def measure(self, texts, max_widths):
+        import numpy
+        paragraph_counts = numpy.array([text.count("\n") + 1 for text in texts], numpy.int64)
+        code_points = numpy.frombuffer("\n".join(texts).encode("UTF-32-LE"), numpy.uint32)
+        glyph_indexes = self.glyph_indexes[numpy.minimum(code_points, len(self.glyph_indexes) - 1)]
+        kerning_indexes = self.kerning_indexes[numpy.minimum(code_points, len(self.kerning_indexes) - 1)]
+        kerning = numpy.zeros(len(code_points) + 1, numpy.int64)
+        kerning[1: len(code_points)] = self.kerning[kerning_indexes[:-1] * self.kerning_size + kerning_indexes[1:]]
+        # The print head never moves back, which keeps positions sorted for the searches below
+        steps = numpy.maximum(self.advances[glyph_indexes] + kerning[:-1], 0)
+        positions = numpy.concatenate([[0], numpy.cumsum(steps)])
+        separators = numpy.flatnonzero((code_points == ord(" ")) | (code_points == ord("\n")))
+        word_starts = numpy.concatenate([[0], separators + 1])
+        word_ends = numpy.append(separators, len(code_points))
+        line_start_positions = positions[word_starts] + kerning[word_starts]
+        word_end_positions = positions[word_ends]
+        paragraph_last_words = numpy.flatnonzero(numpy.append(code_points[separators] == ord("\n"), True))
+        paragraph_widths = numpy.repeat(max_widths, paragraph_counts)
+        line_counts = numpy.zeros(len(paragraph_last_words), numpy.int64)
+        line_widths = numpy.zeros(len(paragraph_last_words), numpy.int64)
+        first_words = numpy.concatenate([[0], paragraph_last_words[:-1] + 1])
+        paragraphs = numpy.arange(len(paragraph_last_words))
+        while len(paragraphs):
+            starts = first_words[paragraphs]
+            ends = numpy.searchsorted(word_end_positions, line_start_positions[starts] + paragraph_widths[paragraphs],
+                                      "right")
+            ends = numpy.clip(ends, starts + 1, paragraph_last_words[paragraphs] + 1)
+            line_counts[paragraphs] += 1
+            line_widths[paragraphs] = numpy.maximum(line_widths[paragraphs],
+                                                    word_end_positions[ends - 1] - line_start_positions[starts])
+            first_words[paragraphs] = ends
+            paragraphs = paragraphs[ends <= paragraph_last_words[paragraphs]]
+        string_starts = numpy.concatenate([[0], numpy.cumsum(paragraph_counts)[:-1]])
+        return numpy.add.reduceat(line_counts, string_starts), numpy.maximum.reduceat(line_widths, string_starts)
+
+
+class TextBoxes:
+    def __init__(self, path, resource_folder):
+        import yaml
+        with open(path, "rt", encoding="UTF-8") as file:
+            dict_ = yaml.load(file, Loader=yaml.BaseLoader)
+        self.resource_folder = resource_folder
+        self.default = dict_.get("Default") or {}
+        self.strgs = {self.normalize_id(strg_id): box or {} for strg_id, box in (dict_.get("STRGs") or {}).items()}
+        self.layouts = {}
+
+    @staticmethod
+    def normalize_id(id_):
+        return id_.upper().removeprefix("0X").rjust(8, "0")
+
+    def get_box(self, strg_box, string_index):
+        box = {}
+        for level in [self.default, strg_box, (strg_box.get("Strings") or {}).get(str(string_index)) or {}]:
+            if "Lines" in level or "Height" in level:
+                box.pop("Lines", None)
+                box.pop("Height", None)
+            box.update((key, value) for key, value in level.items() if key != "Strings")
+        if "Font" not in box or "Width" not in box or ("Lines" not in box and "Height" not in box):
+            return None
+        return {"Font": box["Font"], **{key: int(box[key]) for key in ("Width", "Lines", "Height") if key in box}}
+
+    def get_layout(self, font_id):
+        font_id = self.normalize_id(font_id)
+        if font_id not in self.layouts:
+            self.layouts[font_id] = TextLayout(Font().from_font_txtr(f"{self.resource_folder}/files/{font_id}.FONT",
+                                                                     False))
+        return self.layouts[font_id]
+
+    def check(self, strgs):
+        import numpy
+        groups = {}
+        box_widths = []
+        max_lines = []
+        labels = []
+        texts = []
+        for strg in strgs:
+            strg_box = self.strgs.get(self.normalize_id(strg.id), {})
+            for string_index in range(strg.strings_count):
+                box = self.get_box(strg_box, string_index)
+                if box is None:
+                    continue
+                layout = self.get_layout(box["Font"])
+                groups.setdefault(layout, []).extend(range(len(texts), len(texts) + len(strg.strings)))
+                box_widths += [box["Width"]] * len(strg.strings)
+                max_lines += [layout.get_max_lines(box)] * len(strg.strings)
+                for language, strings in strg.strings.items():
+                    labels.append(f"{strg.id} {string_index} {language}")
+                    texts.append(Charset.MARKUP.sub("", strings[string_index]) if "&" in strings[string_index]
+                                 else strings[string_index])
+        box_widths = numpy.array(box_widths, numpy.int64)
+        max_lines = numpy.array(max_lines, numpy.int64)
+        line_counts = numpy.zeros(len(texts), numpy.int64)
+        line_widths = numpy.zeros(len(texts), numpy.int64)
+        for layout, indexes in groups.items():
+            indexes = numpy.array(indexes, numpy.int64)
+            line_counts[indexes], line_widths[indexes] = layout.measure([texts[index] for index in indexes.tolist()],
+                                                                        box_widths[indexes])
+        overflows = numpy.flatnonzero((line_counts > max_lines) | (line_widths > box_widths)).tolist()
+        for index in overflows:
+            print(f"({labels[index]}) {int(line_counts[index])} lines, widest is {int(line_widths[index])}px, "
+                  f"box is {int(box_widths[index])}px x {int(max_lines[index])} lines: {texts[index][:60]!r}")
+        print(f"{len(overflows)} of {len(texts)} strings overflow their text boxes")
+        return len(overflows)
 
 
 class FontTxtr:
@@ -559,62 +1706,297 @@ class FontTxtr:
 
     def from_txtr(self, path):
         with open(path, "rb") as file:
-            reader = FileReader(file.read())
+            return self.from_bytes(file.read(), path)
+
+    @Profiler.profile("Decode TXTR", "FontTxtr", lambda _, data, name: {"Asset": name.split("/")[-1],
+                                                                          "Bytes": len(data)})
+    def from_bytes(self, data, name):
+        import numpy
+        reader = FileReader(data)
         self.image_format, width, height, mipmap_count, palette_format = reader.read(">L2H2L")
         self.size = [width, height]
         if self.image_format != 4:
-            raise Exception(f"Wrong/unsupported texture format in file {path}")
+            raise Exception(f"Wrong/unsupported texture format in file {name}")
         palette_width, palette_height = reader.read(">2H")
         self.palette_colors = [int(i[0]) for i in reader.iter_read(">H", palette_width * palette_height)]
-        blocks_in_row_count = ceil(self.size[0] / self.BLOCK_SIZE[0])
-        self.images = [Surface(self.size, 0, 8) for _ in range(4)]
-        pixels_count = (blocks_in_row_count * ceil(self.size[1] / self.BLOCK_SIZE[1]) *
-                        self.BLOCK_SIZE[0] * self.BLOCK_SIZE[1])
-        for pixel_index, pixel in enumerate(reader.read_nibbles(pixels_count)):
-            for i, image in enumerate(self.images):
-                if (pixel >> i) & 1:
-                    image.set_at(self.translate_coords(pixel_index, blocks_in_row_count), "White")
+        blocks_count = [ceil(self.size[0] / self.BLOCK_SIZE[0]), ceil(self.size[1] / self.BLOCK_SIZE[1])]
+        data = numpy.frombuffer(reader.bytes, numpy.uint8, blocks_count[0] * blocks_count[1] *
+                                self.BLOCK_SIZE[0] * self.BLOCK_SIZE[1] // 2, reader.offset)
+        pixels = numpy.empty(data.size * 2, numpy.uint8)
+        pixels[0::2] = data >> 4
+        pixels[1::2] = data & 15
+        pixels = self.untile(pixels, blocks_count)[:self.size[1], :self.size[0]]
+        self.set_layers([(pixels >> i) & 1 == 1 for i in range(4)])
         return self
 
+    @Profiler.profile("Read PNGs", "FontTxtr", lambda _, folder, __: {"Path": folder})
     def from_pngs(self, folder, palette):
-        self.images = [image.load(f"{folder}/Layer {i}.png") for i in range(4)]
-        self.size = self.images[0].get_size()
+        self.layers = [self.load_layer(f"{folder}/Layer {i}.png") for i in range(4)]
+        self.size = [self.layers[0].shape[1], self.layers[0].shape[0]]
+        self.palette_colors = palette
+        return self
+
+    def from_layers(self, size, palette, layers):
+        self.size = size
         self.palette_colors = palette
+        self.set_layers(layers)
         return self
 
+    @Profiler.profile("Encode TXTR", "FontTxtr", lambda _, path: {"Asset": path.split("/")[-1]})
     def save_as_txtr(self, path):
+        import numpy
         buffer = struct.pack(">L2H2L2H", 4, self.size[0], self.size[1], 1, 2, 1, 16)
         for color in self.palette_colors:
             buffer += struct.pack(">H", color)
-        blocks_in_row_count = ceil(self.size[0] / self.BLOCK_SIZE[0])
-        pixels_count = (blocks_in_row_count * ceil(self.size[1] / self.BLOCK_SIZE[1]) *
-                        self.BLOCK_SIZE[0] * self.BLOCK_SIZE[1])
-        pixels = []
-        for pixel_index in range(pixels_count):
-            bits = []
-            for image_index, image in enumerate(self.images):
-                bits.append(image.get_at(self.translate_coords(pixel_index, blocks_in_row_count)).r > 127)
-            pixels.append(self.bits_to_int(bits))
-        for i in range(0, len(pixels), 2):
-            buffer += ((pixels[i] << 4) + pixels[i + 1]).to_bytes(1, "big")
+        blocks_count = [ceil(self.size[0] / self.BLOCK_SIZE[0]), ceil(self.size[1] / self.BLOCK_SIZE[1])]
+        pixels = numpy.zeros((blocks_count[1] * self.BLOCK_SIZE[1], blocks_count[0] * self.BLOCK_SIZE[0]), numpy.uint8)
+        for i, layer in enumerate(self.get_layers()):
+            pixels[:self.size[1], :self.size[0]] |= layer.astype(numpy.uint8) << i
+        pixels = self.tile(pixels, blocks_count)
+        buffer += ((pixels[0::2] << 4) | pixels[1::2]).tobytes()
         with open(path, "wb") as file:
             file.write(buffer)
 
+    @Profiler.profile("Write PNGs", "FontTxtr", lambda _, path: {"Path": path})
     def save_as_pngs(self, path):
-        for i, layer in enumerate(self.images):
-            image.save(layer, f"{path}/Layer {i}.png")
+        for i, layer in enumerate(self.layers):
+            Png.save_layer(f"{path}/Layer {i}.png", layer)
+
+    def get_layers(self):
+        return self.layers
+
+    @staticmethod
+    def load_layer(path):
+        return Png.load_red_channel(path) > 127
+
+    def set_layers(self, layers):
+        self.layers = list(layers)
+
+    def untile(self, pixels, blocks_count):
+        return pixels.reshape(blocks_count[1], blocks_count[0], self.BLOCK_SIZE[1], self.BLOCK_SIZE[0]).transpose(
+            0, 2, 1, 3).reshape(blocks_count[1] * self.BLOCK_SIZE[1], blocks_count[0] * self.BLOCK_SIZE[0])
+
+    def tile(self, pixels, blocks_count):
+        return pixels.reshape(blocks_count[1], self.BLOCK_SIZE[1], blocks_count[0], self.BLOCK_SIZE[0]).transpose(
+            0, 2, 1, 3).reshape(-1)
 
-    def translate_coords(self, byte_offset, blocks_in_row_count):
-        block_index = byte_offset // 64
-        pixel_in_block_index = byte_offset % 64
-        block_coords = [block_index % blocks_in_row_count, block_index // blocks_in_row_count]
-        pixel_in_block_coords = [pixel_in_block_index % 8, pixel_in_block_index // 8]
-        return [block_coords[0] * self.BLOCK_SIZE[0] + pixel_in_block_coords[0],
-                block_coords[1] * self.BLOCK_SIZE[1] + pixel_in_block_coords[1]]
+
+class Png:
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+    CHANNEL_COUNTS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    @staticmethod
+    def load_red_channel(path):
+        import numpy
+        with open(path, "rb") as file:
+            data = file.read()
+        if data[:8] != Png.SIGNATURE:
+            raise Exception(f"{path} is not a PNG file")
+        chunks = {}
+        compressed_data = []
+        offset = 8
+        while offset < len(data):
+            length, type_ = struct.unpack_from(">L4s", data, offset)
+            if type_ == b"IDAT":
+                compressed_data.append(data[offset + 8: offset + 8 + length])
+            else:
+                chunks.setdefault(type_, data[offset + 8: offset + 8 + length])
+            offset += length + 12
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">2L5B", chunks[b"IHDR"])
+        if interlace != 0:
+            raise Exception(f"{path} is interlaced, save it without interlacing")
+        channel_count = Png.CHANNEL_COUNTS[color_type]
+        row_size = (width * channel_count * bit_depth + 7) // 8
+        rows = numpy.frombuffer(zlib.decompress(b"".join(compressed_data)), numpy.uint8,
+                                (row_size + 1) * height).reshape(height, row_size + 1)
+        pixels = Png.unfilter(rows[:, 1:], rows[:, 0], max(1, channel_count * bit_depth // 8))
+        if bit_depth < 8:
+            bits = numpy.unpackbits(pixels, axis=1)[:, :width * bit_depth].reshape(height, width, bit_depth)
+            pixels = (bits << numpy.arange(bit_depth - 1, -1, -1, dtype=numpy.uint8)).sum(2, numpy.uint8)
+        red_channel = pixels.reshape(height, width, -1)[:, :, 0]
+        if color_type == 3:
+            palette = numpy.zeros(256, numpy.uint8)
+            palette[: len(chunks[b"PLTE"]) // 3] = numpy.frombuffer(chunks[b"PLTE"], numpy.uint8)[0::3]
+            return palette[red_channel]
+        if bit_depth < 8:
+            return red_channel * (255 // ((1 << bit_depth) - 1))
+        return red_channel
+
+    @staticmethod
+    def unfilter(rows, filter_types, pixel_size):
+        import numpy
+        pixels = numpy.zeros((rows.shape[0] + 1, rows.shape[1] + pixel_size), numpy.uint8)
+        for y, filter_type in enumerate(filter_types.tolist(), 1):
+            if filter_type == 0:
+                pixels[y, pixel_size:] = rows[y - 1]
+            elif filter_type == 1:
+                pixels[y, pixel_size:] = numpy.cumsum(rows[y - 1].reshape(-1, pixel_size), 0, numpy.uint8).reshape(-1)
+            elif filter_type == 2:
+                pixels[y, pixel_size:] = rows[y - 1] + pixels[y - 1, pixel_size:]
+            elif filter_type in (3, 4):
+                row = pixels[y].tolist()
+                previous_row = pixels[y - 1].tolist()
+                for x, value in enumerate(rows[y - 1].tolist(), pixel_size):
+                    left, up, up_left = row[x - pixel_size], previous_row[x], previous_row[x - pixel_size]
+                    if filter_type == 3:
+                        row[x] = (value + ((left + up) >> 1)) & 255
+                        continue
+                    estimate = left + up - up_left
+                    left_distance, up_distance, up_left_distance = (abs(estimate - left), abs(estimate - up),
+                                                                    abs(estimate - up_left))
+                    if left_distance <= up_distance and left_distance <= up_left_distance:
+                        row[x] = (value + left) & 255
+                    elif up_distance <= up_left_distance:
+                        row[x] = (value + up) & 255
+                    else:
+                        row[x] = (value + up_left) & 255
+                pixels[y] = row
+            else:
+                raise Exception(f"Unknown PNG filter type {filter_type}")
+        return pixels[1:, pixel_size:]
+
+    @staticmethod
+    def save_layer(path, layer):
+        import numpy
+        height, width = layer.shape
+        rows = numpy.packbits(layer, axis=1)
+        data = numpy.concatenate([numpy.zeros((height, 1), numpy.uint8), rows], axis=1).tobytes()
+        with open(path, "wb") as file:
+            file.write(Png.SIGNATURE + Png.get_chunk(b"IHDR", struct.pack(">2L5B", width, height, 1, 0, 0, 0, 0)) +
+                       Png.get_chunk(b"IDAT", zlib.compress(data)) + Png.get_chunk(b"IEND", b""))
+
+    @staticmethod
+    def get_chunk(type_, data):
+        return struct.pack(">L", len(data)) + type_ + data + struct.pack(">L", zlib.crc32(type_ + data))
+
+
+class GlyphRasterizer:
+    def __init__(self, font_path, size, threshold=128, cache_folder=None):
+        self.font_path = font_path
+        self.size = size
+        self.threshold = threshold
+        self.font = None
+        self.glyphs = {}
+        self.cache_path = None
+        if cache_folder is not None:
+            with open(font_path, "rb") as file:
+                hash_ = hashlib.sha256(file.read())
+            hash_.update(f"size {size} threshold {threshold}".encode("ASCII"))
+            self.cache_path = f"{cache_folder}/{hash_.hexdigest()}.json"
+            if exists(self.cache_path):
+                with open(self.cache_path, "rt", encoding="UTF-8") as file:
+                    self.glyphs = json.load(file)
 
     @staticmethod
-    def bits_to_int(bits):
-        return sum(map(lambda x: x[1] << x[0], enumerate(bits)))
+    def get_characters(settings):
+        characters = list(settings.get("Characters", ""))
+        for character_range in settings.get("Character ranges", []):
+            first, last = (int(code_point, 16) for code_point in str(character_range).split("-"))
+            characters += [chr(code_point) for code_point in range(first, last + 1)]
+        return list(dict.fromkeys(characters))
+
+    def rasterize(self, characters):
+        import numpy
+        glyphs = {}
+        missing_characters = []
+        is_cache_outdated = False
+        for character in characters:
+            if character not in self.glyphs:
+                self.glyphs[character] = self.render(character)
+                is_cache_outdated = True
+            if self.glyphs[character] is None:
+                missing_characters.append(f"U+{ord(character):04X}")
+                continue
+            width, height, left, top, advance, bits = self.glyphs[character]
+            bitmap = numpy.unpackbits(numpy.frombuffer(bytes.fromhex(bits), numpy.uint8), count=width * height)
+            glyphs[character] = (bitmap.reshape(height, width).astype(bool), {
+                "Left padding": max(-128, min(127, left)),
+                "Right padding": max(-128, min(127, advance - left - width)),
+                "Vertical offset": max(0, min(255, top))
+            })
+        if is_cache_outdated and self.cache_path is not None:
+            if not exists(self.cache_path[:self.cache_path.rfind("/")]):
+                makedirs(self.cache_path[:self.cache_path.rfind("/")])
+            with open(f"{self.cache_path}.tmp", "wt", encoding="UTF-8") as file:
+                json.dump(self.glyphs, file)
+            replace(f"{self.cache_path}.tmp", self.cache_path)
+        if missing_characters:
+            print(f"No glyphs in {self.font_path} for {len(missing_characters)} characters: "
+                  f"{' '.join(missing_characters)}")
+        return glyphs
+
+    def render(self, character):
+        import numpy
+        if self.font is None:
+            environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+            from pygame import freetype
+            freetype.init()
+            self.font = freetype.Font(self.font_path, self.size)
+        metrics = self.font.get_metrics(character)
+        if not metrics or metrics[0] is None:
+            return None
+        rect = self.font.get_rect(character)
+        data, (width, height) = self.font.render_raw(character)
+        bitmap = numpy.frombuffer(data, numpy.uint8).reshape(height, width) >= self.threshold
+        return [width, height, rect.x, rect.y, round(metrics[0][4]), numpy.packbits(bitmap).tobytes().hex()]
+
+
+class GlyphAtlas:
+    LAYER_COUNT = 4
+
+    def __init__(self, size, spacing=1):
+        if size[0] % FontTxtr.BLOCK_SIZE[0] != 0 or size[1] % FontTxtr.BLOCK_SIZE[1] != 0:
+            raise Exception(f"Texture size {size} is not a multiple of the {FontTxtr.BLOCK_SIZE} block size")
+        self.size = size
+        self.spacing = spacing
+
+    def pack(self, bitmaps):
+        placements = {}
+        shelves = []
+        layer_heights = [0] * self.LAYER_COUNT
+        for character in sorted(bitmaps, key=lambda character_: (-bitmaps[character_].shape[0],
+                                                                 -bitmaps[character_].shape[1], character_)):
+            height, width = bitmaps[character].shape
+            if width == 0 or height == 0:
+                placements[character] = (0, 0, 0)
+                continue
+            shelf = next((shelf for shelf in shelves if height <= shelf[2] and shelf[3] + width <= self.size[0]),
+                         None)
+            if shelf is None:
+                shelf = self.add_shelf(shelves, layer_heights, height)
+                if shelf is None or width > self.size[0]:
+                    raise Exception(f"Glyphs don't fit into {self.LAYER_COUNT} layers of size {self.size}")
+            placements[character] = (shelf[0], shelf[3], shelf[1])
+            shelf[3] += width + self.spacing
+        return placements
+
+    def shrink(self, bitmaps):
+        min_height, max_height = 1, self.size[1] // FontTxtr.BLOCK_SIZE[1]
+        while min_height < max_height:
+            height = (min_height + max_height) // 2
+            try:
+                GlyphAtlas([self.size[0], height * FontTxtr.BLOCK_SIZE[1]], self.spacing).pack(bitmaps)
+                max_height = height
+            except Exception:
+                min_height = height + 1
+        self.size = [self.size[0], min_height * FontTxtr.BLOCK_SIZE[1]]
+        return self.size
+
+    def add_shelf(self, shelves, layer_heights, height):
+        for layer_index, layer_height in enumerate(layer_heights):
+            if layer_height + height <= self.size[1]:
+                shelves.append([layer_index, layer_height, height, 0])
+                layer_heights[layer_index] += height + self.spacing
+                return shelves[-1]
+        return None
+
+    def render(self, bitmaps, placements):
+        import numpy
+        layers = [numpy.zeros((self.size[1], self.size[0]), bool) for _ in range(self.LAYER_COUNT)]
+        for character, (layer_index, x, y) in placements.items():
+            height, width = bitmaps[character].shape
+            layers[layer_index][y: y + height, x: x + width] = bitmaps[character]
+        return layers
 
 
 if __name__ == "__main__":